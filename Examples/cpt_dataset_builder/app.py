@@ -1,277 +1,114 @@
-import io
-import json
-import re
-import unicodedata
-from collections import Counter, defaultdict
-from dataclasses import dataclass
-from typing import List, Tuple, Dict, Optional
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterator, List, Tuple, Dict, Optional
 
 import streamlit as st
 
-# Try best-effort PDF extractors. Prefer PyMuPDF for quality.
-try:
-    import fitz  # PyMuPDF
-    HAS_FITZ = True
-except Exception:
-    HAS_FITZ = False
-
-try:
-    from pypdf import PdfReader
-    HAS_PYPDF = True
-except Exception:
-    HAS_PYPDF = False
-
-# Optional token counting (graceful fallback)
-try:
-    import tiktoken
-    enc = tiktoken.get_encoding("cl100k_base")
-    def count_tokens(text: str) -> int:
-        return len(enc.encode(text))
-except Exception:
-    def count_tokens(text: str) -> int:
-        # crude fallback ~4 chars per token
-        return max(1, len(text) // 4)
-
-
-@dataclass
-class Chunk:
-    doc_name: str
-    index: int
-    text: str
-    pages: Tuple[int, int]
-    n_tokens: int
-
-
-def normalize(text: str) -> str:
-    text = unicodedata.normalize("NFKC", text)
-    # Convert Windows line endings, collapse weird spaces
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = re.sub("\xa0", " ", text)
-    return text
-
-
-def dehyphenate(text: str) -> str:
-    # Join words split across line breaks: e.g., "hyphen-\nation" -> "hyphenation"
-    text = re.sub(r"(\w+)-\n(\w+)", r"\1\2", text)
-    return text
-
-
-def remove_page_numbers(line: str) -> bool:
-    return bool(re.fullmatch(r"(?i)(page\s*)?\d+\s*(of\s*\d+)?", line.strip()))
-
-
-def extract_with_pymupdf(file_bytes: bytes) -> List[Tuple[int, str]]:
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    pages = []
-    for i, page in enumerate(doc, start=1):
-        # use blocks to better preserve reading order
-        text = page.get_text("text")
-        pages.append((i, text or ""))
-    return pages
-
-
-def extract_with_pypdf(file_bytes: bytes) -> List[Tuple[int, str]]:
-    reader = PdfReader(io.BytesIO(file_bytes))
-    pages = []
-    for i, p in enumerate(reader.pages, start=1):
-        try:
-            text = p.extract_text() or ""
-        except Exception:
-            text = ""
-        pages.append((i, text))
-    return pages
-
-
-def extract_pdf_pages(file_bytes: bytes) -> List[Tuple[int, str]]:
-    if HAS_FITZ:
-        return extract_with_pymupdf(file_bytes)
-    elif HAS_PYPDF:
-        return extract_with_pypdf(file_bytes)
-    else:
-        raise RuntimeError("No PDF extractor available. Install PyMuPDF (pip install pymupdf) or pypdf.")
-
-
-def strip_headers_footers(pages: List[Tuple[int, str]], threshold: float = 0.6) -> List[Tuple[int, str]]:
+from pipeline import (AUDIT_HEADER, BuildCache, Chunk, QualityFilter, audit_line, dataset_stats, extractor_backend,
+                      jsonl_line, make_dedupe_index, process_document, warm_up, word_set)
+
+# Shared with the CLI's default --cache-dir, so either one reuses the other's extraction and chunks.
+CACHE_DIR = os.environ.get("CPT_CACHE_DIR", ".cpt_cache")
+
+
+@st.cache_resource
+def build_cache() -> BuildCache:
+    return BuildCache(CACHE_DIR)
+
+
+@st.cache_resource
+def worker_pool(workers: int) -> ProcessPoolExecutor:
     """
-    Heuristic: find short lines (<=120 chars) that repeat on >= threshold of pages and remove them.
-    Helps remove headers, footers, and running titles.
+    Long-lived process pool like the CLI's (PyMuPDF is not thread-safe, and threads would
+    share the GIL anyway). Spawned rather than forked, since the Streamlit server is threaded.
     """
-    line_occurs: Counter = Counter()
-    page_lines: List[List[str]] = []
-    for _, text in pages:
-        lines = [l.strip() for l in text.splitlines() if l.strip()]
-        page_lines.append(lines)
-        for l in lines:
-            if len(l) <= 120 and not remove_page_numbers(l):
-                line_occurs[l] += 1
-
-    n_pages = max(1, len(pages))
-    repeated = {l for l, c in line_occurs.items() if c / n_pages >= threshold}
-
-    cleaned_pages = []
-    for (i, _), lines in zip(pages, page_lines):
-        kept = []
-        for l in lines:
-            if l in repeated:
-                continue
-            if remove_page_numbers(l):
-                continue
-            kept.append(l)
-        cleaned_pages.append((i, "\n".join(kept)))
-
-    return cleaned_pages
-
-
-def basic_clean(text: str) -> str:
-    text = normalize(text)
-    text = dehyphenate(text)
-    # Collapse 3+ newlines to 2, and extra spaces
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    text = re.sub(r"[ \t]{2,}", " ", text)
-    return text.strip()
-
-
-def chunk_text(text: str, target_tokens: int = 1000, overlap_tokens: int = 100) -> List[str]:
-    """Simple token-aware chunker that tries to break on paragraph boundaries."""
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
-    chunks: List[str] = []
-    cur: List[str] = []
-    cur_tok = 0
-
-    for p in paragraphs:
-        ptoks = count_tokens(p)
-        if ptoks > target_tokens * 1.5:
-            # very large paragraph; split by sentences as a fallback
-            sentences = re.split(r"(?<=[.!?])[\s\n]+", p)
-            for s in sentences:
-                stoks = count_tokens(s)
-                if cur_tok + stoks > target_tokens and cur:
-                    chunks.append("\n\n".join(cur).strip())
-                    # start next window with minimal overlap (last chunk tail)
-                    if overlap_tokens > 0 and chunks[-1]:
-                        tail = chunks[-1].split()[-overlap_tokens:]
-                        cur = [" ".join(tail)]
-                        cur_tok = count_tokens(cur[0])
-                    else:
-                        cur, cur_tok = [], 0
-                cur.append(s)
-                cur_tok += stoks
-            continue
-
-        if cur_tok + ptoks > target_tokens and cur:
-            chunks.append("\n\n".join(cur).strip())
-            if overlap_tokens > 0 and chunks[-1]:
-                tail = chunks[-1].split()[-overlap_tokens:]
-                cur = [" ".join(tail)]
-                cur_tok = count_tokens(cur[0])
-            else:
-                cur, cur_tok = [], 0
-        cur.append(p)
-        cur_tok += ptoks
-
-    if cur:
-        chunks.append("\n\n".join(cur).strip())
-
-    # final cleanup
-    chunks = [c for c in chunks if c and len(c.split()) >= 5]
-    return chunks
-
-
-def dedupe_chunks(chunks: List[Chunk], min_jaccard: float = 0.9) -> List[Chunk]:
-    """Very simple near-duplicate removal using Jaccard similarity on word sets."""
-    kept: List[Chunk] = []
-    signatures: List[set] = []
-    for ch in chunks:
-        ws = set(w.lower() for w in re.findall(r"\w+", ch.text))
-        is_dup = False
-        for sig in signatures:
-            inter = len(ws & sig)
-            union = max(1, len(ws | sig))
-            if inter / union >= min_jaccard:
-                is_dup = True
-                break
-        if not is_dup:
-            kept.append(ch)
-            signatures.append(ws)
-    return kept
-
-
-def build_dataset_from_pdfs(files, target_tokens: int, overlap_tokens: int, rm_headers: bool, do_dedupe: bool):
-    chunks: List[Chunk] = []
-    audit_rows = []
-
-    for f in files:
-        file_bytes = f.getvalue()
-        pages = extract_pdf_pages(file_bytes)
-        if rm_headers:
-            pages = strip_headers_footers(pages)
-        page_texts = []
-        for pno, ptxt in pages:
-            cleaned = basic_clean(ptxt)
-            page_texts.append((pno, cleaned))
-        full_text = "\n\n".join(t for _, t in page_texts if t)
-        # Chunk at document level but keep rough page bounds for audit
-        doc_chunks = chunk_text(full_text, target_tokens=target_tokens, overlap_tokens=overlap_tokens)
-
-        # Map chunk to page span by best-effort greedy allocation
-        # (approximate; good enough for audit)
-        cum_pages = []
-        for pno, t in page_texts:
-            cum_pages.append((pno, len(t)))
-        total_chars = sum(c for _, c in cum_pages) or 1
-        char_to_page = []
-        running = 0
-        for pno, clen in cum_pages:
-            char_to_page.append((running, running + clen, pno))
-            running += clen
-
-        offset = 0
-        for idx, text in enumerate(doc_chunks):
-            # find page span by character offsets
-            span_start = offset
-            span_end = offset + len(text)
-            offset = span_end
-            pages_covered = [p for s, e, p in char_to_page if not (e <= span_start or s >= span_end)]
-            if pages_covered:
-                pmin, pmax = min(pages_covered), max(pages_covered)
-            else:
-                pmin = pmax = 1
-            chunks.append(Chunk(
-                doc_name=f.name,
-                index=len(chunks),
-                text=text,
-                pages=(pmin, pmax),
-                n_tokens=count_tokens(text),
-            ))
-
-    if do_dedupe:
-        chunks = dedupe_chunks(chunks)
-
-    # Build outputs
-    jsonl_bytes = io.BytesIO()
-    audit_csv = io.StringIO()
-    total_tokens = 0
+    return ProcessPoolExecutor(max_workers=workers, initializer=warm_up,
+                               mp_context=multiprocessing.get_context("spawn"))
 
-    for ch in chunks:
-        record = {"text": ch.text}
-        jsonl_bytes.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
-        total_tokens += ch.n_tokens
 
-    # Audit CSV
-    audit_csv.write("chunk_id,doc_name,page_start,page_end,approx_tokens\n")
-    for ch in chunks:
-        audit_csv.write(f"{ch.index},{ch.doc_name},{ch.pages[0]},{ch.pages[1]},{ch.n_tokens}\n")
+def spill_upload(f, path: str) -> str:
+    """Stream an upload to a temp file, which workers then mmap (no whole-upload bytes copy)."""
+    f.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+    return path
 
-    jsonl_bytes.seek(0)
-    audit_bytes = io.BytesIO(audit_csv.getvalue().encode("utf-8"))
 
-    stats = {
-        "num_documents": len(files),
-        "num_chunks": len(chunks),
-        "total_approx_tokens": total_tokens,
-        "avg_tokens_per_chunk": (total_tokens // max(1, len(chunks))) if chunks else 0,
-    }
-    return chunks, jsonl_bytes, audit_bytes, stats
+def iter_processed_uploads(files, target_tokens: int, overlap_tokens: int, rm_headers: bool,
+                           workers: int = 4) -> Iterator[Tuple[int, List[Chunk]]]:
+    """
+    Process uploads with process_document, on a process pool if workers > 1, and yield
+    (upload index, chunks) as each one finishes. Pages and chunks are cached by content
+    hash, so changing the chunk settings only re-chunks.
+    """
+    cache = build_cache()
+    with tempfile.TemporaryDirectory(prefix="cpt_uploads_") as tmp:
+        paths = [spill_upload(f, os.path.join(tmp, f"{i:05d}.pdf")) for i, f in enumerate(files)]
+        kwargs = dict(target_tokens=target_tokens, overlap_tokens=overlap_tokens, rm_headers=rm_headers, cache=cache)
+        if workers <= 1 or len(paths) <= 1:
+            for i, fp in enumerate(paths):
+                yield i, process_document(fp, **kwargs)
+        else:
+            pool = worker_pool(workers)
+            futures = {pool.submit(process_document, fp, **kwargs): i for i, fp in enumerate(paths)}
+            for fut in as_completed(futures):
+                yield futures[fut], fut.result()
+    cache.evict()
+
+
+def build_dataset_from_pdfs(files, target_tokens: int, overlap_tokens: int, rm_headers: bool, do_dedupe: bool,
+                            preview_size: int = 12, workers: int = 4, quality_filter: Optional[QualityFilter] = None,
+                            on_file_done: Optional[Callable[[int, int], None]] = None,
+                            on_update: Optional[Callable[[Dict[str, int], List[Chunk]], None]] = None):
+    """
+    Stream chunks straight into temp files (spilled to disk) instead of in-memory buffers.
+    Uploads are processed concurrently; on_file_done(upload index, n_chunks) fires as each
+    finishes, while dedupe and writing follow upload order so ids and output are stable,
+    calling on_update(stats so far, preview) after each document. Only the preview is retained.
+    """
+    jsonl_file = tempfile.TemporaryFile()
+    audit_file = tempfile.TemporaryFile()
+    audit_file.write((AUDIT_HEADER + "\n").encode("utf-8"))
+    dedupe_index = make_dedupe_index() if do_dedupe else None
+    preview: List[Chunk] = []
+    num_chunks = 0
+    total_tokens = 0
+    index = 0
+    finished: Dict[int, List[Chunk]] = {}
+    next_doc = 0
+
+    for i, doc_chunks in iter_processed_uploads(files, target_tokens, overlap_tokens, rm_headers, workers):
+        if on_file_done is not None:
+            on_file_done(i, len(doc_chunks))
+        finished[i] = doc_chunks
+        while next_doc in finished:
+            doc_name = files[next_doc].name
+            for ch in finished.pop(next_doc):
+                ch.doc_name = doc_name
+                ch.index = index
+                index += 1
+                if quality_filter is not None and not quality_filter.passes(ch.quality):
+                    continue
+                if dedupe_index is not None and not dedupe_index.add_if_new(word_set(ch.text)):
+                    continue
+                jsonl_file.write((jsonl_line(ch) + "\n").encode("utf-8"))
+                audit_file.write((audit_line(ch) + "\n").encode("utf-8"))
+                num_chunks += 1
+                total_tokens += ch.n_tokens
+                if len(preview) < preview_size:
+                    preview.append(ch)
+            next_doc += 1
+            if on_update is not None:
+                on_update(dataset_stats(next_doc, num_chunks, total_tokens), preview)
+
+    jsonl_file.seek(0)
+    audit_file.seek(0)
+
+    stats = dataset_stats(len(files), num_chunks, total_tokens)
+    return preview, jsonl_file, audit_file, stats
 
 
 # ---------------- UI -----------------
@@ -291,8 +128,14 @@ with st.sidebar:
                              help="Find lines repeated on most pages and drop them.")
     do_dedupe = st.checkbox("Near-duplicate removal", True,
                             help="Remove chunks with very high Jaccard similarity (≥0.9).")
+    do_quality = st.checkbox("Drop low-quality chunks", False,
+                             help="Skip chunks that are mostly symbols/digits, garbled, or heavily repetitive. "
+                                  "Scores are always written to the audit CSV.")
+    workers = st.number_input("Parallel workers", 1, 32, min(4, os.cpu_count() or 1),
+                              help="Worker processes for uploads. Extraction results are cached per file, "
+                                   "so changing chunk settings only re-chunks.")
     st.markdown("---")
-    st.markdown("**Extraction backend**: " + ("PyMuPDF" if HAS_FITZ else ("pypdf" if HAS_PYPDF else "<none>")))
+    st.markdown("**Extraction backend**: " + {"pymupdf": "PyMuPDF", "pypdf": "pypdf"}.get(extractor_backend(), "<none>"))
 
 uploaded = st.file_uploader("Drop PDF files here", type=["pdf"], accept_multiple_files=True)
 
@@ -305,41 +148,72 @@ with col1:
 with col2:
     st.info("Output: JSONL (`{""text"": ...}` per line) + CSV audit of chunk origins.")
 
-if run and uploaded:
-    with st.spinner("Processing PDFs..."):
-        chunks, jsonl_bytes, audit_bytes, stats = build_dataset_from_pdfs(
-            uploaded, target_tokens, overlap_tokens, rm_headers, do_dedupe
-        )
+def render_metrics(box, stats: Dict[str, int]) -> None:
+    with box.container():
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Documents", stats["num_documents"])
+        m2.metric("Chunks", stats["num_chunks"])
+        m3.metric("Total ~Tokens", stats["total_approx_tokens"])
+        m4.metric("Avg Tokens/Chunk", stats["avg_tokens_per_chunk"])
 
-    st.subheader("Results")
-    m1, m2, m3, m4 = st.columns(4)
-    m1.metric("Documents", stats["num_documents"])
-    m2.metric("Chunks", stats["num_chunks"])
-    m3.metric("Total ~Tokens", stats["total_approx_tokens"])
-    m4.metric("Avg Tokens/Chunk", stats["avg_tokens_per_chunk"])
-
-    st.download_button(
-        "⬇️ Download dataset.jsonl",
-        data=jsonl_bytes,
-        file_name="dataset.jsonl",
-        mime="application/jsonl",
-        use_container_width=True,
-    )
 
-    st.download_button(
-        "⬇️ Download audit.csv",
-        data=audit_bytes,
-        file_name="audit.csv",
-        mime="text/csv",
-        use_container_width=True,
-    )
+def render_preview(box, preview: List[Chunk]) -> None:
+    with box.container():
+        for ch in preview:
+            with st.expander(f"{ch.doc_name} · pages {ch.pages[0]}–{ch.pages[1]} · ~{ch.n_tokens} tokens"):
+                st.write(ch.text)
+
+
+if run and uploaded:
+    progress = st.progress(0.0, text=f"Processing 0/{len(uploaded)} PDF(s)...")
+    with st.expander("Files", expanded=len(uploaded) <= 10):
+        file_rows = [st.empty() for _ in uploaded]
+    for row, f in zip(file_rows, uploaded):
+        row.markdown(f"⏳ {f.name}")
 
+    st.subheader("Results")
+    metrics_box = st.empty()
+    downloads_box = st.container()
     st.markdown("---")
     st.subheader("Preview (first 12 chunks)")
-    preview = chunks[:12]
-    for ch in preview:
-        with st.expander(f"{ch.doc_name} · pages {ch.pages[0]}–{ch.pages[1]} · ~{ch.n_tokens} tokens"):
-            st.write(ch.text)
+    preview_box = st.empty()
+    files_done = []
+
+    def on_file_done(i: int, n_chunks: int) -> None:
+        files_done.append(i)
+        file_rows[i].markdown(f"✅ {uploaded[i].name} · {n_chunks} chunks")
+        progress.progress(len(files_done) / len(uploaded),
+                          text=f"Processing {len(files_done)}/{len(uploaded)} PDF(s)...")
+
+    def on_update(stats: Dict[str, int], preview: List[Chunk]) -> None:
+        render_metrics(metrics_box, stats)
+        render_preview(preview_box, preview)
+
+    preview, jsonl_file, audit_file, stats = build_dataset_from_pdfs(
+        uploaded, target_tokens, overlap_tokens, rm_headers, do_dedupe,
+        workers=int(workers), quality_filter=QualityFilter() if do_quality else None,
+        on_file_done=on_file_done, on_update=on_update,
+    )
+    progress.progress(1.0, text=f"Processed {len(uploaded)} PDF(s).")
+    render_metrics(metrics_box, stats)
+    render_preview(preview_box, preview)
+
+    with downloads_box:
+        st.download_button(
+            "⬇️ Download dataset.jsonl",
+            data=jsonl_file,
+            file_name="dataset.jsonl",
+            mime="application/jsonl",
+            use_container_width=True,
+        )
+
+        st.download_button(
+            "⬇️ Download audit.csv",
+            data=audit_file,
+            file_name="audit.csv",
+            mime="text/csv",
+            use_container_width=True,
+        )
 
 elif run and not uploaded:
     st.warning("Please upload at least one PDF.")
@@ -0,0 +1,255 @@
+"""
+Benchmark the CPT dataset pipeline on deterministic synthetic PDFs.
+
+    python bench.py --sizes small medium --output bench.json
+    python bench.py --sizes small --output new.json --compare bench.json
+
+Each scenario generates its corpus once (same seed -> same bytes) under --workdir, then
+runs the production build (write_dataset_from_pdfs) in a fresh process and reports its
+per-stage Metrics, wall time and that process's peak RSS. With --warm-cache the measured
+build runs against a cache filled by an unmeasured first build.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import pipeline
+
+SCENARIOS: Dict[str, dict] = {
+    # docs, pages per doc, fraction of docs that are exact copies, header/footer style
+    "small": {"docs": 5, "pages": 10, "dup_rate": 0.2, "headers": "running"},
+    "medium": {"docs": 20, "pages": 50, "dup_rate": 0.1, "headers": "running+pageno"},
+    "large": {"docs": 50, "pages": 200, "dup_rate": 0.1, "headers": "running+pageno"},
+    "no-headers": {"docs": 20, "pages": 50, "dup_rate": 0.0, "headers": "none"},
+    "dup-heavy": {"docs": 40, "pages": 20, "dup_rate": 0.5, "headers": "running"},
+}
+
+STAGES = ["extract", "strip_headers", "clean", "chunk", "quality", "cache", "dedupe", "write"]
+
+
+def _pdf_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: List[List[str]]) -> bytes:
+    """Minimal uncompressed PDF: one Helvetica text line per entry, 12pt leading."""
+    n = len(pages)
+    font_obj = 3 + 2 * n
+    objs: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{3 + 2 * i} 0 R" for i in range(n)), n)).encode(),
+    ]
+    for i, lines in enumerate(pages):
+        objs.append((f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                     f"/Resources << /Font << /F1 {font_obj} 0 R >> >> /Contents {4 + 2 * i} 0 R >>").encode())
+        ops = ["BT", "/F1 9 Tf", "11 TL", "36 770 Td"]
+        ops += [f"({_pdf_escape(line)}) Tj T*" for line in lines]
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+
+def synthetic_pages(rng: random.Random, vocab: List[str], n_pages: int, headers: str, title: str) -> List[List[str]]:
+    pages = []
+    for pno in range(1, n_pages + 1):
+        lines = [f"{title} - Service Manual"] if headers != "none" else []
+        for _ in range(rng.randint(3, 5)):
+            for k in range(rng.randint(4, 8)):
+                words = [rng.choice(vocab) for _ in range(rng.randint(8, 13))]
+                if rng.random() < 0.05:
+                    # split the last word across the line break to exercise dehyphenate
+                    w = words[-1] + "ation"
+                    words[-1] = w[:3] + "-"
+                    lines.append(" ".join(words))
+                    words = [w[3:]]
+                lines.append(" ".join(words) + ("." if rng.random() < 0.3 else ""))
+            lines.append("")
+        if "pageno" in headers:
+            lines.append(f"Page {pno} of {n_pages}")
+        pages.append(lines)
+    return pages
+
+
+def generate_corpus(root: str, name: str, spec: dict, seed: int = 1234) -> List[str]:
+    """Write the scenario's PDFs under root/name (skipped if already generated) and return their paths."""
+    out_dir = os.path.join(root, name)
+    marker = os.path.join(out_dir, "spec.json")
+    expected = json.dumps({"spec": spec, "seed": seed}, sort_keys=True)
+    if os.path.exists(marker) and open(marker, encoding="utf-8").read() == expected:
+        return sorted(os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.endswith(".pdf"))
+
+    os.makedirs(out_dir, exist_ok=True)
+    for f in os.listdir(out_dir):
+        if f.endswith(".pdf"):
+            os.remove(os.path.join(out_dir, f))
+    rng = random.Random(seed)
+    vocab = ["".join(rng.choice("abcdefghiklmnoprstuvwy") for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    n_unique = max(1, round(spec["docs"] * (1 - spec["dup_rate"])))
+    paths = []
+    blobs: List[bytes] = []
+    for d in range(spec["docs"]):
+        if d < n_unique:
+            blob = make_pdf(synthetic_pages(rng, vocab, spec["pages"], spec["headers"], f"Manual {d}"))
+            blobs.append(blob)
+        else:
+            blob = blobs[rng.randrange(len(blobs))]
+        path = os.path.join(out_dir, f"doc{d:05d}.pdf")
+        with open(path, "wb") as f:
+            f.write(blob)
+        paths.append(path)
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(expected)
+    return paths
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_scenario(paths: List[str], target_tokens: int, overlap_tokens: int, chunker: str, dedupe: str,
+                 workers: int = 1, page_batch: int = 256, warm_cache: bool = False) -> dict:
+    """One build of paths through the production pipeline; meant to run in its own process (see main)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = pipeline.BuildCache(os.path.join(tmp, "cache")) if warm_cache else None
+
+        def build(metrics: pipeline.Metrics) -> dict:
+            return pipeline.write_dataset_from_pdfs(
+                paths, os.path.join(tmp, "dataset.jsonl"), os.path.join(tmp, "audit.csv"), target_tokens,
+                overlap_tokens, rm_headers=True, do_dedupe=dedupe != "none", workers=workers,
+                dedupe_method=dedupe if dedupe != "none" else "minhash", cache=cache, chunker=chunker,
+                metrics=metrics, page_batch=page_batch)
+
+        if warm_cache:
+            build(pipeline.Metrics())
+        metrics = pipeline.Metrics()
+        t0 = time.perf_counter()
+        build(metrics)
+        total = time.perf_counter() - t0
+
+    counters = metrics.counters
+    stages = {stage: metrics.stages.get(stage, [0.0])[0] for stage in STAGES}
+    res = {
+        "documents": len(paths),
+        "pages": counters["pages"],
+        "chars": counters["chars"],
+        "chunks": counters["chunks"],
+        "chunks_kept": counters["chunks_kept"],
+        "tokens": counters["tokens_kept"],
+        "documents_cached": counters["documents_cached"],
+        # summed over worker processes, so with --workers > 1 they can add up to more than total_seconds
+        "seconds": {stage: round(v, 6) for stage, v in stages.items()},
+        "total_seconds": round(total, 6),
+        "pages_per_sec": round(counters["pages"] / total, 2) if total else None,
+        "chunks_per_sec": round(counters["chunks"] / total, 2) if total else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if workers > 1:
+        res["worker_peak_rss_mb"] = round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+    return res
+
+
+def run_isolated(*args) -> dict:
+    """run_scenario in a fresh process, so ru_maxrss covers that scenario alone."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_scenario, *args).result()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current: dict, baseline: dict) -> None:
+    print(f"Compared with {baseline.get('commit', '?')} (ratio = baseline seconds / current seconds, >1 is faster):")
+    for name, res in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        parts = []
+        for stage in STAGES + ["total"]:
+            cur_s = res["total_seconds"] if stage == "total" else res["seconds"][stage]
+            base_s = base["total_seconds"] if stage == "total" else base["seconds"].get(stage, 0.0)
+            if cur_s > 0 and base_s > 0:
+                parts.append(f"{stage} x{base_s / cur_s:.2f}")
+        print(f"  {name}: " + ", ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPT dataset pipeline on synthetic PDFs")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=sorted(SCENARIOS),
+                        help="Scenarios to run")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "cpt_bench_corpus"),
+                        help="Where synthetic PDFs are generated (reused across runs)")
+    parser.add_argument("--output", default="bench.json", help="Write results as JSON here")
+    parser.add_argument("--compare", help="Earlier bench JSON to compare against")
+    parser.add_argument("--target_tokens", type=int, default=1200)
+    parser.add_argument("--overlap_tokens", type=int, default=80)
+    parser.add_argument("--chunker", choices=pipeline.CHUNKERS, default="paragraph")
+    parser.add_argument("--dedupe", choices=["minhash", "exact", "none"], default="minhash")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, as in the CLI")
+    parser.add_argument("--page-batch", type=int, default=256,
+                        help="Documents with more pages are streamed instead of held (as in the CLI)")
+    parser.add_argument("--warm-cache", action="store_true",
+                        help="Measure a rebuild against a build cache filled by an unmeasured first run")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "extractor": pipeline.extractor_backend(),
+        "params": {"target_tokens": args.target_tokens, "overlap_tokens": args.overlap_tokens,
+                   "chunker": args.chunker, "dedupe": args.dedupe, "seed": args.seed, "workers": args.workers,
+                   "page_batch": args.page_batch, "warm_cache": args.warm_cache},
+        "scenarios": {},
+    }
+    for name in args.sizes:
+        paths = generate_corpus(args.workdir, name, SCENARIOS[name], args.seed)
+        res = run_isolated(paths, args.target_tokens, args.overlap_tokens, args.chunker, args.dedupe, args.workers,
+                           args.page_batch, args.warm_cache)
+        results["scenarios"][name] = res
+        print(f"{name}: {res['pages']} pages, {res['chunks']} chunks in {res['total_seconds']:.2f}s "
+              f"({res['pages_per_sec']} pages/s, {res['chunks_per_sec']} chunks/s, peak RSS {res['peak_rss_mb']} MB"
+              + (f", {res['documents_cached']} document(s) from cache" if res["documents_cached"] else "") + ")")
+        for stage in STAGES:
+            print(f"    {stage:<14}{res['seconds'][stage]:.3f}s")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
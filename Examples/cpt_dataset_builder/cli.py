@@ -1,271 +1,49 @@
 import argparse
 import glob
-import io
 import json
 import os
-import re
-import unicodedata
-from collections import Counter, defaultdict
-from dataclasses import dataclass
-from typing import List, Tuple, Dict, Optional
-
-# Try best-effort PDF extractors. Prefer PyMuPDF for quality.
-try:
-    import fitz  # PyMuPDF
-    HAS_FITZ = True
-except Exception:
-    HAS_FITZ = False
-
-try:
-    from pypdf import PdfReader
-    HAS_PYPDF = True
-except Exception:
-    HAS_PYPDF = False
-
-# Optional token counting (graceful fallback)
-try:
-    import tiktoken
-    enc = tiktoken.get_encoding("cl100k_base")
-    def count_tokens(text: str) -> int:
-        return len(enc.encode(text))
-except Exception:
-    def count_tokens(text: str) -> int:
-        # crude fallback ~4 chars per token
-        return max(1, len(text) // 4)
-
-
-@dataclass
-class Chunk:
-    doc_name: str
-    index: int
-    text: str
-    pages: Tuple[int, int]
-    n_tokens: int
-
-
-def normalize(text: str) -> str:
-    text = unicodedata.normalize("NFKC", text)
-    # Convert Windows line endings, collapse weird spaces
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = re.sub("\xa0", " ", text)
-    return text
-
-
-def dehyphenate(text: str) -> str:
-    # Join words split across line breaks: e.g., "hyphen-\nation" -> "hyphenation"
-    text = re.sub(r"(\w+)-\n(\w+)", r"\1\2", text)
-    return text
-
-
-def remove_page_numbers(line: str) -> bool:
-    return bool(re.fullmatch(r"(?i)(page\s*)?\d+\s*(of\s*\d+)?", line.strip()))
-
-
-def extract_with_pymupdf(file_bytes: bytes) -> List[Tuple[int, str]]:
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    pages = []
-    for i, page in enumerate(doc, start=1):
-        # use blocks to better preserve reading order
-        text = page.get_text("text")
-        pages.append((i, text or ""))
-    return pages
-
-
-def extract_with_pypdf(file_bytes: bytes) -> List[Tuple[int, str]]:
-    reader = PdfReader(io.BytesIO(file_bytes))
-    pages = []
-    for i, p in enumerate(reader.pages, start=1):
-        try:
-            text = p.extract_text() or ""
-        except Exception:
-            text = ""
-        pages.append((i, text))
-    return pages
-
-
-def extract_pdf_pages(file_bytes: bytes) -> List[Tuple[int, str]]:
-    if HAS_FITZ:
-        return extract_with_pymupdf(file_bytes)
-    elif HAS_PYPDF:
-        return extract_with_pypdf(file_bytes)
-    else:
-        raise RuntimeError("No PDF extractor available. Install PyMuPDF (pip install pymupdf) or pypdf.")
-
-
-def strip_headers_footers(pages: List[Tuple[int, str]], threshold: float = 0.6) -> List[Tuple[int, str]]:
-    """
-    Heuristic: find short lines (<=120 chars) that repeat on >= threshold of pages and remove them.
-    Helps remove headers, footers, and running titles.
-    """
-    line_occurs: Counter = Counter()
-    page_lines: List[List[str]] = []
-    for _, text in pages:
-        lines = [l.strip() for l in text.splitlines() if l.strip()]
-        page_lines.append(lines)
-        for l in lines:
-            if len(l) <= 120 and not remove_page_numbers(l):
-                line_occurs[l] += 1
-
-    n_pages = max(1, len(pages))
-    repeated = {l for l, c in line_occurs.items() if c / n_pages >= threshold}
-
-    cleaned_pages = []
-    for (i, _), lines in zip(pages, page_lines):
-        kept = []
-        for l in lines:
-            if l in repeated:
-                continue
-            if remove_page_numbers(l):
-                continue
-            kept.append(l)
-        cleaned_pages.append((i, "\n".join(kept)))
-
-    return cleaned_pages
-
-
-def basic_clean(text: str) -> str:
-    text = normalize(text)
-    text = dehyphenate(text)
-    # Collapse 3+ newlines to 2, and extra spaces
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    text = re.sub(r"[ \t]{2,}", " ", text)
-    return text.strip()
-
-
-def chunk_text(text: str, target_tokens: int = 1000, overlap_tokens: int = 100) -> List[str]:
-    """Simple token-aware chunker that tries to break on paragraph boundaries."""
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
-    chunks: List[str] = []
-    cur: List[str] = []
-    cur_tok = 0
-
-    for p in paragraphs:
-        ptoks = count_tokens(p)
-        if ptoks > target_tokens * 1.5:
-            # very large paragraph; split by sentences as a fallback
-            sentences = re.split(r"(?<=[.!?])[\s\n]+", p)
-            for s in sentences:
-                stoks = count_tokens(s)
-                if cur_tok + stoks > target_tokens and cur:
-                    chunks.append("\n\n".join(cur).strip())
-                    # start next window with minimal overlap (last chunk tail)
-                    if overlap_tokens > 0 and chunks[-1]:
-                        tail = chunks[-1].split()[-overlap_tokens:]
-                        cur = [" ".join(tail)]
-                        cur_tok = count_tokens(cur[0])
-                    else:
-                        cur, cur_tok = [], 0
-                cur.append(s)
-                cur_tok += stoks
-            continue
-
-        if cur_tok + ptoks > target_tokens and cur:
-            chunks.append("\n\n".join(cur).strip())
-            if overlap_tokens > 0 and chunks[-1]:
-                tail = chunks[-1].split()[-overlap_tokens:]
-                cur = [" ".join(tail)]
-                cur_tok = count_tokens(cur[0])
-            else:
-                cur, cur_tok = [], 0
-        cur.append(p)
-        cur_tok += ptoks
-
-    if cur:
-        chunks.append("\n\n".join(cur).strip())
-
-    # final cleanup
-    chunks = [c for c in chunks if c and len(c.split()) >= 5]
-    return chunks
-
-
-def dedupe_chunks(chunks: List[Chunk], min_jaccard: float = 0.9) -> List[Chunk]:
-    """Very simple near-duplicate removal using Jaccard similarity on word sets."""
-    kept: List[Chunk] = []
-    signatures: List[set] = []
-    for ch in chunks:
-        ws = set(w.lower() for w in re.findall(r"\w+", ch.text))
-        is_dup = False
-        for sig in signatures:
-            inter = len(ws & sig)
-            union = max(1, len(ws | sig))
-            if inter / union >= min_jaccard:
-                is_dup = True
-                break
-        if not is_dup:
-            kept.append(ch)
-            signatures.append(ws)
-    return kept
-
-
-def build_dataset_from_pdfs(file_paths: List[str], target_tokens: int, overlap_tokens: int, rm_headers: bool, do_dedupe: bool):
-    chunks: List[Chunk] = []
-
-    for fp in file_paths:
-        with open(fp, 'rb') as f:
-            file_bytes = f.read()
-        pages = extract_pdf_pages(file_bytes)
-        if rm_headers:
-            pages = strip_headers_footers(pages)
-        page_texts = []
-        for pno, ptxt in pages:
-            cleaned = basic_clean(ptxt)
-            page_texts.append((pno, cleaned))
-        full_text = "\n\n".join(t for _, t in page_texts if t)
-        # Chunk at document level but keep rough page bounds for audit
-        doc_chunks = chunk_text(full_text, target_tokens=target_tokens, overlap_tokens=overlap_tokens)
-
-        # Map chunk to page span by best-effort greedy allocation
-        # (approximate; good enough for audit)
-        cum_pages = []
-        for pno, t in page_texts:
-            cum_pages.append((pno, len(t)))
-        total_chars = sum(c for _, c in cum_pages) or 1
-        char_to_page = []
-        running = 0
-        for pno, clen in cum_pages:
-            char_to_page.append((running, running + clen, pno))
-            running += clen
-
-        offset = 0
-        for idx, text in enumerate(doc_chunks):
-            # find page span by character offsets
-            span_start = offset
-            span_end = offset + len(text)
-            offset = span_end
-            pages_covered = [p for s, e, p in char_to_page if not (e <= span_start or s >= span_end)]
-            if pages_covered:
-                pmin, pmax = min(pages_covered), max(pages_covered)
-            else:
-                pmin = pmax = 1
-            chunks.append(Chunk(
-                doc_name=os.path.basename(fp),
-                index=len(chunks),
-                text=text,
-                pages=(pmin, pmax),
-                n_tokens=count_tokens(text),
-            ))
-
-    if do_dedupe:
-        chunks = dedupe_chunks(chunks)
-
-    # Build outputs
-    jsonl_lines = []
-    audit_lines = ["chunk_id,doc_name,page_start,page_end,approx_tokens"]
-    total_tokens = 0
-
-    for ch in chunks:
-        record = {"text": ch.text}
-        jsonl_lines.append(json.dumps(record, ensure_ascii=False))
-        total_tokens += ch.n_tokens
-        audit_lines.append(f"{ch.index},{ch.doc_name},{ch.pages[0]},{ch.pages[1]},{ch.n_tokens}")
-
-    stats = {
-        "num_documents": len(file_paths),
-        "num_chunks": len(chunks),
-        "total_approx_tokens": total_tokens,
-        "avg_tokens_per_chunk": (total_tokens // max(1, len(chunks))) if chunks else 0,
-    }
-    return jsonl_lines, audit_lines, stats
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline import (CHUNKERS, COMPRESSIONS, BuildCache, IncrementalBuild, Metrics, QualityFilter, arrow_available,
+                      cleaner, compression_available, semantic_available, shard_stem, warm_up, watch_pdfs,
+                      write_dataset_from_pdfs, write_text_atomic)
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return n
+
+
+def run_watch(args, build_kwargs: dict, workers: int, metrics: Metrics) -> None:
+    """--watch: keep appending new/changed PDFs in input_dir until SIGINT/SIGTERM."""
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    def on_batch(paths, stats):
+        print(f"Added {len(paths)} PDF(s): {stats['num_chunks']} chunks, "
+              f"~{stats['total_approx_tokens']} tokens in {stats['num_documents']} document(s) so far")
+        if args.metrics_json:
+            write_text_atomic(args.metrics_json, json.dumps(metrics.to_dict(), indent=2))
+        if args.metrics_prom:
+            write_text_atomic(args.metrics_prom, metrics.to_prometheus())
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=warm_up) if workers > 1 else None
+    build = IncrementalBuild(resume=True, pool=pool, **build_kwargs)
+    print(f"Watching {args.input_dir} with {workers} worker(s); Ctrl-C to stop")
+    try:
+        watch_pdfs(args.input_dir, build, args.poll_seconds, args.settle_seconds, stop, on_batch)
+    finally:
+        build.close(finished=False)
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    print(f"Stopped; run again with --watch (or --resume) to continue. Outputs: {args.output_jsonl}, "
+          f"{args.output_csv}")
 
 
 def main():
@@ -274,20 +52,91 @@ def main():
     parser.add_argument("--input_file", help="Path to a single PDF file")
     parser.add_argument("--output_jsonl", default="dataset.jsonl", help="Output JSONL file")
     parser.add_argument("--output_csv", default="audit.csv", help="Output audit CSV file")
-    parser.add_argument("--target_tokens", type=int, default=1200, help="Target tokens per chunk")
+    parser.add_argument("--output_arrow",
+                        help="Also write the dataset as Arrow IPC (memory-mappable) or, for a .parquet path, Parquet "
+                             "(needs pyarrow)")
+    parser.add_argument("--target_tokens", type=positive_int, default=1200, help="Target tokens per chunk")
     parser.add_argument("--overlap_tokens", type=int, default=80, help="Overlap tokens between chunks")
+    parser.add_argument("--chunker", choices=CHUNKERS, default="paragraph",
+                        help="paragraph: greedy paragraph packing; token: exact token windows/overlap that prefer "
+                             "paragraph or sentence breaks; pack: exact windows filled to --target_tokens (trainer max length)")
+    parser.add_argument("--shard-records", type=int, default=0,
+                        help="Split the JSONL into shards of about this many records (<stem>-00000-of-00042.jsonl)")
+    parser.add_argument("--shard-mb", type=int, default=0,
+                        help="Split the JSONL into shards of about this many uncompressed MB")
+    parser.add_argument("--compress", choices=sorted(COMPRESSIONS), default="none",
+                        help="Compress JSONL shards (zstd needs the zstandard package); implies sharded output "
+                             "with a <stem>.manifest.json")
     parser.add_argument("--no_rm_headers", action="store_true", help="Do not remove repeated headers/footers")
     parser.add_argument("--no_dedupe", action="store_true", help="Do not perform near-duplicate removal")
+    parser.add_argument("--dedupe", choices=["minhash", "exact", "none"], default="minhash",
+                        help="Near-duplicate removal: MinHash/LSH (default, needs numpy), exact all-pairs, or none")
+    parser.add_argument("--semantic-dedupe", nargs="?", const="hashing", metavar="MODEL",
+                        help="Also drop semantic near-duplicates by embedding cosine similarity. MODEL is a local "
+                             "sentence-transformers model name/path, or 'hashing' (default, offline) for a hashing "
+                             "vectorizer. Needs numpy")
+    parser.add_argument("--semantic-threshold", type=float, default=0.92,
+                        help="Cosine similarity at or above which a chunk counts as a semantic duplicate")
+    defaults = QualityFilter()
+    parser.add_argument("--quality-filter", action="store_true",
+                        help="Drop low-quality chunks by the thresholds below. Off by default, so output matches "
+                             "builds without it; scores are always written to the audit CSV")
+    parser.add_argument("--min-alpha-ratio", type=float, default=defaults.min_alpha_ratio,
+                        help="Drop chunks where letters make up less than this share of non-space characters")
+    parser.add_argument("--min-mean-word-len", type=float, default=defaults.min_mean_word_len,
+                        help="Drop chunks whose mean word length is below this")
+    parser.add_argument("--max-mean-word-len", type=float, default=defaults.max_mean_word_len,
+                        help="Drop chunks whose mean word length is above this")
+    parser.add_argument("--max-repeat-ngram", type=float, default=defaults.max_repeat_ngram_frac,
+                        help="Drop chunks where more than this share of word 3-grams are repeats")
+    parser.add_argument("--max-line-len-cv", type=float, default=defaults.max_line_len_cv,
+                        help="Drop chunks whose line lengths vary more than this (std / mean; off by default)")
+    parser.add_argument("--min-lang-conf", type=float, default=defaults.min_lang_conf,
+                        help="Drop chunks whose English function-word score is below this (0-1; off by default)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for extraction/cleaning/chunking (0 = one per CPU)")
+    parser.add_argument("--cache-dir", default=".cpt_cache", help="Directory for the extraction/chunking cache")
+    parser.add_argument("--cache-max-mb", type=int, default=2048, help="Evict least recently used cache entries above this size")
+    parser.add_argument("--page-batch", type=int, default=256,
+                        help="PDFs with more pages than this are streamed page by page instead of held in memory")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the build cache")
+    parser.add_argument("--clean-timings", action="store_true",
+                        help="Report time spent in each cleaning rule (runs with a single worker)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from the last completed document in the outputs, or add "
+                             "new/changed inputs to a finished one")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and append new or changed PDFs in input_dir as they arrive "
+                             "(inotify etc. via watchdog if installed, else polling); implies --resume")
+    parser.add_argument("--poll-seconds", type=float, default=5.0, help="--watch: rescan input_dir this often")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="--watch: wait until a PDF is unmodified for this long before reading it")
+    parser.add_argument("--checkpoint-seconds", type=float, default=300,
+                        help="How often to fsync the outputs and snapshot the dedupe indexes for --resume (0 = never)")
+    parser.add_argument("--metrics-json", help="Write per-stage timings, counters and per-document timings as JSON")
+    parser.add_argument("--metrics-prom", help="Write the same metrics in Prometheus text format (textfile collector)")
+    parser.add_argument("--profile", nargs="?", const="cpt_build.prof",
+                        help="Run under cProfile + tracemalloc and save pstats here (default: cpt_build.prof). "
+                             "Only the parent process is profiled; use --workers 1 to profile the whole pipeline")
 
     args = parser.parse_args()
 
-    if args.input_file:
+    if args.watch:
+        if not args.input_dir or not os.path.isdir(args.input_dir):
+            print("--watch needs an input_dir to watch")
+            return
+        if args.output_arrow:
+            print("--output_arrow is written when a build finishes and cannot be used with --watch")
+            return
+        pdf_files = []
+    elif args.input_file:
         if not os.path.isfile(args.input_file):
             print(f"File not found: {args.input_file}")
             return
         pdf_files = [args.input_file]
     elif args.input_dir:
-        pdf_files = glob.glob(os.path.join(args.input_dir, "*.pdf"))
+        # sorted so chunk ids are stable across runs and worker counts
+        pdf_files = sorted(glob.glob(os.path.join(args.input_dir, "*.pdf")))
         if not pdf_files:
             print(f"No PDF files found in {args.input_dir}")
             return
@@ -295,28 +144,106 @@ def main():
         print("Either input_dir or --input_file must be provided")
         return
 
-    rm_headers = not args.no_rm_headers
-    do_dedupe = not args.no_dedupe
+    if args.output_arrow and not arrow_available():
+        print("--output_arrow needs pyarrow (pip install pyarrow)")
+        return
 
-    print(f"Processing {len(pdf_files)} PDF(s)...")
-    jsonl_lines, audit_lines, stats = build_dataset_from_pdfs(
-        pdf_files, args.target_tokens, args.overlap_tokens, rm_headers, do_dedupe
-    )
+    if not compression_available(args.compress):
+        print("--compress zstd needs zstandard (pip install zstandard)")
+        return
 
-    with open(args.output_jsonl, 'w', encoding='utf-8') as f:
-        for line in jsonl_lines:
-            f.write(line + '\n')
+    if args.semantic_dedupe and not semantic_available(args.semantic_dedupe):
+        print("--semantic-dedupe needs numpy" + ("" if args.semantic_dedupe == "hashing" else
+                                                 " and sentence-transformers (pip install sentence-transformers)"))
+        return
 
-    with open(args.output_csv, 'w', encoding='utf-8') as f:
-        for line in audit_lines:
-            f.write(line + '\n')
+    sharded = args.compress != "none" or args.shard_records > 0 or args.shard_mb > 0
+
+    quality_filter = None if not args.quality_filter else QualityFilter(
+        min_alpha_ratio=args.min_alpha_ratio, min_mean_word_len=args.min_mean_word_len,
+        max_mean_word_len=args.max_mean_word_len, max_repeat_ngram_frac=args.max_repeat_ngram,
+        max_line_len_cv=args.max_line_len_cv, min_lang_conf=args.min_lang_conf,
+    )
+    rm_headers = not args.no_rm_headers
+    do_dedupe = not args.no_dedupe and args.dedupe != "none"
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    cache = None if args.no_cache else BuildCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    if args.clean_timings:
+        # rule timings accumulate in this process, and cached documents skip cleaning entirely
+        cleaner.timed = True
+        workers = 1
+        cache = None
+
+    metrics = Metrics()
+    if args.watch:
+        run_watch(args, dict(
+            jsonl_path=args.output_jsonl, csv_path=args.output_csv, target_tokens=args.target_tokens,
+            overlap_tokens=args.overlap_tokens, rm_headers=rm_headers, do_dedupe=do_dedupe, workers=workers,
+            dedupe_method=args.dedupe, cache=cache, chunker=args.chunker, metrics=metrics,
+            page_batch=args.page_batch, compression=args.compress, shard_records=args.shard_records,
+            shard_bytes=args.shard_mb * 1024 * 1024, semantic=args.semantic_dedupe,
+            semantic_threshold=args.semantic_threshold, quality_filter=quality_filter,
+            checkpoint_seconds=args.checkpoint_seconds,
+        ), workers, metrics)
+        return
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    print(f"Processing {len(pdf_files)} PDF(s) with {workers} worker(s)...")
+    wall, cpu = time.perf_counter(), time.process_time()
+    stats = write_dataset_from_pdfs(
+        pdf_files, args.output_jsonl, args.output_csv, args.target_tokens, args.overlap_tokens, rm_headers,
+        do_dedupe, workers, args.dedupe, cache, resume=args.resume, chunker=args.chunker, metrics=metrics,
+        page_batch=args.page_batch, arrow_path=args.output_arrow, compression=args.compress,
+        shard_records=args.shard_records, shard_bytes=args.shard_mb * 1024 * 1024,
+        semantic=args.semantic_dedupe, semantic_threshold=args.semantic_threshold, quality_filter=quality_filter,
+        checkpoint_seconds=args.checkpoint_seconds,
+    )
+    metrics.gauges["build_wall_seconds"] = round(time.perf_counter() - wall, 6)
+    metrics.gauges["build_parent_cpu_seconds"] = round(time.process_time() - cpu, 6)
+    metrics.gauges["workers"] = workers
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        _, heap_peak = tracemalloc.get_traced_memory()
+        metrics.gauges["python_heap_peak_bytes"] = heap_peak
+        top_allocs = tracemalloc.take_snapshot().statistics("lineno")[:10]
+        tracemalloc.stop()
 
     print("Results:")
     print(f"  Documents: {stats['num_documents']}")
     print(f"  Chunks: {stats['num_chunks']}")
     print(f"  Total ~Tokens: {stats['total_approx_tokens']}")
     print(f"  Avg Tokens/Chunk: {stats['avg_tokens_per_chunk']}")
-    print(f"Outputs: {args.output_jsonl}, {args.output_csv}")
+    jsonl_output = shard_stem(args.output_jsonl) + ".manifest.json (shards)" if sharded else args.output_jsonl
+    print(f"Outputs: {jsonl_output}, {args.output_csv}" + (f", {args.output_arrow}" if args.output_arrow else ""))
+    if args.clean_timings:
+        print("Cleaning rule timings:")
+        for name, seconds in cleaner.report():
+            print(f"  {name}: {seconds:.3f}s")
+    if args.metrics_json:
+        write_text_atomic(args.metrics_json, json.dumps(metrics.to_dict(), indent=2))
+        print(f"Metrics: {args.metrics_json}")
+    if args.metrics_prom:
+        write_text_atomic(args.metrics_prom, metrics.to_prometheus())
+        print(f"Prometheus metrics: {args.metrics_prom}")
+    if profiler is not None:
+        import pstats
+        print("Stage timings (wall / cpu seconds):")
+        for name, (stage_wall, stage_cpu, _) in sorted(metrics.stages.items(), key=lambda kv: -kv[1][0]):
+            print(f"  {name:<22}{stage_wall:10.3f}{stage_cpu:10.3f}")
+        print(f"Top functions by cumulative time (full stats in {args.profile}):")
+        pstats.Stats(args.profile).sort_stats("cumulative").print_stats(20)
+        print(f"Python heap peak: {metrics.gauges['python_heap_peak_bytes'] / 1e6:.1f} MB; top allocation sites:")
+        for stat in top_allocs:
+            print(f"  {stat}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,2284 @@
+"""
+Shared CPT dataset pipeline: PDF extraction, cleaning, chunking, dedupe and dataset output.
+Used by cli.py, app.py and bench.py.
+
+Optional backends (PyMuPDF / pypdf, tiktoken, numpy, pyarrow, zstandard,
+sentence-transformers, watchdog) are imported on first use and cached
+per process, so importing this module stays cheap.
+"""
+import glob
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import queue
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Tuple, Dict, Optional
+
+# Try best-effort PDF extractors. Prefer PyMuPDF for quality.
+@lru_cache(maxsize=None)
+def _fitz():
+    try:
+        import fitz  # PyMuPDF
+        return fitz
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _pypdf():
+    try:
+        import pypdf
+        return pypdf
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+        return pyarrow
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _watchdog():
+    try:
+        import watchdog.events
+        import watchdog.observers
+        return watchdog
+    except Exception:
+        return None
+
+
+def arrow_available() -> bool:
+    return _pyarrow() is not None
+
+
+@lru_cache(maxsize=None)
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _sentence_transformers():
+    try:
+        import sentence_transformers
+        return sentence_transformers
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    try:
+        import numpy
+        return numpy
+    except Exception:
+        return None
+
+
+# Optional token counting (graceful fallback)
+@lru_cache(maxsize=None)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def tokenizer_name() -> str:
+    """Identifies how tokens are counted, for cache keys: chunk sizes and counts depend on it."""
+    return "cl100k_base" if _encoding() is not None else "approx4"
+
+
+def _count_tokens(text: str) -> int:
+    enc = _encoding()
+    if enc is None:
+        # crude fallback ~4 chars per token
+        return max(1, len(text) // 4)
+    return len(enc.encode(text))
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    enc = _encoding()
+    if enc is None:
+        return [_count_tokens(t) for t in texts]
+    return [len(ids) for ids in enc.encode_batch(texts)] if texts else []
+
+
+def encode_with_offsets(text: str) -> Tuple[array, array]:
+    enc = _encoding()
+    if enc is None:
+        # fallback "tokens" are 4-char pieces; there is no vocabulary, so ids are all 0
+        offsets = array("I", range(0, len(text), 4))
+        return array("I", bytes(4 * len(offsets))), offsets
+    ids = enc.encode(text)
+    _, offsets = enc.decode_with_offsets(ids)
+    return array("I", ids), array("I", offsets)
+
+
+def warm_up() -> None:
+    """Load the extractor and tokenizer now; process-pool initializer so workers start warm."""
+    extractor_backend()
+    _encoding()
+
+
+# Headers, boilerplate and overlap tails repeat constantly; memoize short strings only
+MEMO_MAX_CHARS = 512
+
+
+@lru_cache(maxsize=65536)
+def _count_tokens_memo(text: str) -> int:
+    return _count_tokens(text)
+
+
+def count_tokens(text: str) -> int:
+    if len(text) <= MEMO_MAX_CHARS:
+        return _count_tokens_memo(text)
+    return _count_tokens(text)
+
+
+@dataclass
+class Chunk:
+    __slots__ = ("doc_name", "index", "text", "pages", "n_tokens", "quality")
+    doc_name: str
+    index: int
+    text: str
+    pages: Tuple[int, int]
+    n_tokens: int
+    quality: Tuple[float, ...]  # quality_scores() in QUALITY_FIELDS order, () if not scored
+
+
+class ChunkStore:
+    """
+    Columnar chunk storage: texts live in one shared UTF-8 buffer addressed by offsets,
+    ids/pages/token counts in typed arrays, and each doc name is stored once. Iterating
+    or indexing materializes Chunk objects on demand.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("q", [0])
+        self.chunk_ids = array("q")
+        self.doc_ids = array("i")
+        self.page_starts = array("i")
+        self.page_ends = array("i")
+        self.n_tokens = array("i")
+        self.quality = [array("d") for _ in QUALITY_FIELDS]  # NaN when not scored
+        self.doc_names: List[str] = []
+        self._doc_lookup: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def append(self, ch: Chunk) -> None:
+        doc_id = self._doc_lookup.get(ch.doc_name)
+        if doc_id is None:
+            doc_id = self._doc_lookup[ch.doc_name] = len(self.doc_names)
+            self.doc_names.append(ch.doc_name)
+        self.data += ch.text.encode("utf-8")
+        self.offsets.append(len(self.data))
+        self.chunk_ids.append(ch.index)
+        self.doc_ids.append(doc_id)
+        self.page_starts.append(ch.pages[0])
+        self.page_ends.append(ch.pages[1])
+        self.n_tokens.append(ch.n_tokens)
+        for col, value in zip(self.quality, ch.quality or _UNSCORED):
+            col.append(value)
+
+    def extend(self, chunks: Iterable[Chunk]) -> None:
+        for ch in chunks:
+            self.append(ch)
+
+    def text(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def __getitem__(self, i: int) -> Chunk:
+        if i < 0:
+            i += len(self)
+        quality = tuple(col[i] for col in self.quality)
+        return Chunk(doc_name=self.doc_names[self.doc_ids[i]], index=self.chunk_ids[i], text=self.text(i),
+                     pages=(self.page_starts[i], self.page_ends[i]), n_tokens=self.n_tokens[i],
+                     quality=() if quality[0] != quality[0] else quality)
+
+    def __iter__(self) -> Iterator[Chunk]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def clear(self) -> None:
+        self.__init__()
+
+
+_DEHYPHENATE_RE = re.compile(r"(\w+)-\n(\w+)")
+# 3+ newlines and runs of spaces/tabs use disjoint characters, so one pass matches two subs
+_WHITESPACE_RUN_RE = re.compile(r"\n{3,}|[ \t]{2,}")
+_PAGE_NUMBER_RE = re.compile(r"(?i)(page\s*)?\d+\s*(of\s*\d+)?")
+
+
+def _nfkc(text: str) -> str:
+    # ASCII text is already NFKC-normal
+    return text if text.isascii() else unicodedata.normalize("NFKC", text)
+
+
+def _unify_newlines(text: str) -> str:
+    if "\r" not in text:
+        return text
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _replace_nbsp(text: str) -> str:
+    return text.replace("\xa0", " ") if "\xa0" in text else text
+
+
+def dehyphenate(text: str) -> str:
+    # Join words split across line breaks: e.g., "hyphen-\nation" -> "hyphenation"
+    if "-\n" not in text:
+        return text
+    return _DEHYPHENATE_RE.sub(r"\1\2", text)
+
+
+def _collapse_whitespace_run(m: "re.Match") -> str:
+    return "\n\n" if m.group()[0] == "\n" else " "
+
+
+def collapse_whitespace(text: str) -> str:
+    # Collapse 3+ newlines to 2, and extra spaces
+    return _WHITESPACE_RUN_RE.sub(_collapse_whitespace_run, text)
+
+
+def normalize(text: str) -> str:
+    text = _nfkc(text)
+    # Convert Windows line endings, collapse weird spaces
+    return _replace_nbsp(_unify_newlines(text))
+
+
+def remove_page_numbers(line: str) -> bool:
+    return _PAGE_NUMBER_RE.fullmatch(line.strip()) is not None
+
+
+class CleaningPipeline:
+    """
+    Ordered list of (name, fn) text rules applied by basic_clean. Rules can be appended,
+    removed or reordered; with timed=True the wall time of each rule is accumulated
+    in self.timings (seconds) so costly rules can be spotted on a real corpus.
+    """
+
+    def __init__(self, rules: List[Tuple[str, Callable[[str], str]]], timed: bool = False):
+        self.rules = list(rules)
+        self.timed = timed
+        self.timings: Counter = Counter()
+
+    def __call__(self, text: str) -> str:
+        if not self.timed:
+            for _, rule in self.rules:
+                text = rule(text)
+            return text
+        for name, rule in self.rules:
+            t0 = time.perf_counter()
+            text = rule(text)
+            self.timings[name] += time.perf_counter() - t0
+        return text
+
+    def report(self) -> List[Tuple[str, float]]:
+        return [(name, self.timings[name]) for name, _ in self.rules]
+
+
+DEFAULT_CLEANING_RULES: List[Tuple[str, Callable[[str], str]]] = [
+    ("nfkc", _nfkc),
+    ("newlines", _unify_newlines),
+    ("nbsp", _replace_nbsp),
+    ("dehyphenate", dehyphenate),
+    ("whitespace", collapse_whitespace),
+    ("strip", str.strip),
+]
+
+cleaner = CleaningPipeline(DEFAULT_CLEANING_RULES)
+
+
+def extract_with_pymupdf(file_bytes: bytes) -> List[Tuple[int, str]]:
+    doc = _fitz().open(stream=file_bytes, filetype="pdf")
+    pages = []
+    for i, page in enumerate(doc, start=1):
+        # use blocks to better preserve reading order
+        text = page.get_text("text")
+        pages.append((i, text or ""))
+    return pages
+
+
+def _pypdf_page_text(page) -> str:
+    try:
+        return page.extract_text() or ""
+    except Exception:
+        return ""
+
+
+def extract_with_pypdf(file_bytes: bytes) -> List[Tuple[int, str]]:
+    reader = _pypdf().PdfReader(io.BytesIO(file_bytes))
+    pages = []
+    for i, p in enumerate(reader.pages, start=1):
+        pages.append((i, _pypdf_page_text(p)))
+    return pages
+
+
+def extractor_backend() -> str:
+    return "pymupdf" if _fitz() else ("pypdf" if _pypdf() else "none")
+
+
+def extract_pdf_pages(file_bytes: bytes) -> List[Tuple[int, str]]:
+    if _fitz():
+        return extract_with_pymupdf(file_bytes)
+    elif _pypdf():
+        return extract_with_pypdf(file_bytes)
+    else:
+        raise RuntimeError("No PDF extractor available. Install PyMuPDF (pip install pymupdf) or pypdf.")
+
+
+class PdfSource:
+    """
+    A PDF on disk, memory-mapped instead of read into a bytes object. PyMuPDF opens it by
+    path and pypdf reads straight from the mapping, so no full-file copy is made.
+    Pages are extracted on demand by range; use as a context manager to release the handles.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.stat = os.fstat(self._file.fileno())
+        self._sha256: Optional[str] = None
+        try:
+            self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.buffer = b""  # empty files cannot be mapped
+        self._doc = None
+
+    def __enter__(self) -> "PdfSource":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def content_hash(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.buffer).hexdigest()
+        return self._sha256
+
+    def fingerprint(self) -> dict:
+        """Size and mtime when opened plus sha256 of the mapped contents, as recorded for resume."""
+        return {"size": self.stat.st_size, "mtime_ns": self.stat.st_mtime_ns, "sha256": self.content_hash()}
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            if _fitz():
+                self._doc = _fitz().open(self.path, filetype="pdf")
+            elif _pypdf():
+                self._doc = _pypdf().PdfReader(self.buffer if isinstance(self.buffer, mmap.mmap) else io.BytesIO(self.buffer))
+            else:
+                raise RuntimeError("No PDF extractor available. Install PyMuPDF (pip install pymupdf) or pypdf.")
+        return self._doc
+
+    @property
+    def page_count(self) -> int:
+        return self.doc.page_count if _fitz() else len(self.doc.pages)
+
+    def page_text(self, i: int) -> str:
+        """Raw text of the 0-based page i."""
+        if _fitz():
+            return self.doc.load_page(i).get_text("text") or ""
+        return _pypdf_page_text(self.doc.pages[i])
+
+    def iter_pages(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+        """Lazily yield (1-based page number, text) for pages[start:stop]."""
+        stop = self.page_count if stop is None else min(stop, self.page_count)
+        for i in range(start, stop):
+            yield i + 1, self.page_text(i)
+
+    def close(self) -> None:
+        if self._doc is not None and _fitz():
+            self._doc.close()
+        self._doc = None
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self._file.close()
+
+
+class HeaderFooterDetector:
+    """Line statistics for strip_headers_footers, fed one page at a time."""
+
+    def __init__(self):
+        self.line_occurs: Counter = Counter()
+        self.page_numbers: set = set()
+        self.n_pages = 0
+
+    def observe(self, text: str) -> None:
+        self.n_pages += 1
+        for l in map(str.strip, text.splitlines()):
+            if not l or l in self.page_numbers:
+                continue
+            if _PAGE_NUMBER_RE.fullmatch(l):
+                self.page_numbers.add(l)
+            elif len(l) <= 120:
+                self.line_occurs[l] += 1
+
+    def repeated(self, threshold: float = 0.6) -> set:
+        n_pages = max(1, self.n_pages)
+        return {l for l, c in self.line_occurs.items() if c / n_pages >= threshold}
+
+    def drop_set(self, threshold: float = 0.6) -> set:
+        """Repeated lines plus every page-number line seen."""
+        return self.repeated(threshold) | self.page_numbers
+
+
+HEADER_SAMPLE_PAGES = 64
+
+
+class CountMinSketch:
+    """Fixed-size frequency sketch for strings; estimates never undercount."""
+
+    def __init__(self, width: int = 4096, depth: int = 4):
+        self.width = width
+        self.rows = [array("I", bytes(4 * width)) for _ in range(depth)]
+
+    def _cells(self, item: str) -> Iterator[Tuple[array, int]]:
+        data = item.encode("utf-8")
+        h1 = zlib.crc32(data)
+        h2 = zlib.adler32(data) | 1
+        for i, row in enumerate(self.rows):
+            yield row, (h1 + i * h2) % self.width
+
+    def add(self, item: str) -> int:
+        """Count item once and return its new estimate."""
+        est = None
+        for row, j in self._cells(item):
+            row[j] += 1
+            est = row[j] if est is None else min(est, row[j])
+        return est
+
+    def estimate(self, item: str) -> int:
+        return min(row[j] for row, j in self._cells(item))
+
+
+def sample_page_indices(n_pages: int, sample: int = HEADER_SAMPLE_PAGES) -> List[int]:
+    """Evenly spaced 0-based page indices; every page when the document is short."""
+    if n_pages <= sample:
+        return list(range(n_pages))
+    return [(i * n_pages) // sample for i in range(sample)]
+
+
+class SampledHeaderDetector:
+    """
+    First pass of streaming header/footer removal: short lines from a sample of pages are
+    counted in a CountMinSketch, and only lines whose estimate reaches the threshold are
+    kept as candidates, so memory is bounded by the sketch, not the document. The second
+    pass drops repeated() lines and page-number lines page by page with strip_lines.
+    """
+
+    def __init__(self, n_sampled: int, threshold: float = 0.6):
+        self.n_sampled = max(1, n_sampled)
+        self.threshold = threshold
+        self.sketch = CountMinSketch()
+        self.candidates: set = set()
+
+    def observe(self, text: str) -> None:
+        min_count = self.threshold * self.n_sampled
+        for l in map(str.strip, text.splitlines()):
+            if not l or len(l) > 120 or _PAGE_NUMBER_RE.fullmatch(l):
+                continue
+            if self.sketch.add(l) >= min_count:
+                self.candidates.add(l)
+
+    def repeated(self) -> set:
+        return {l for l in self.candidates if self.sketch.estimate(l) / self.n_sampled >= self.threshold}
+
+
+def strip_lines(text: str, drop: set, check_page_numbers: bool = False) -> str:
+    """Strip and drop blank lines and lines in drop (and, optionally, any page-number line)."""
+    kept = []
+    for l in map(str.strip, text.splitlines()):
+        if not l or l in drop:
+            continue
+        if check_page_numbers and _PAGE_NUMBER_RE.fullmatch(l):
+            continue
+        kept.append(l)
+    return "\n".join(kept)
+
+
+def strip_headers_footers(pages: List[Tuple[int, str]], threshold: float = 0.6) -> List[Tuple[int, str]]:
+    """
+    Heuristic: find short lines (<=120 chars) that repeat on >= threshold of pages and remove them.
+    Helps remove headers, footers, and running titles.
+    """
+    detector = HeaderFooterDetector()
+    for _, text in pages:
+        detector.observe(text)
+    drop = detector.drop_set(threshold)
+    return [(i, strip_lines(text, drop)) for i, text in pages]
+
+
+def basic_clean(text: str) -> str:
+    return cleaner(text)
+
+
+PARAGRAPH_JOINER = "\n\n"
+
+
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])[\s\n]+")
+_NON_SPACE_RE = re.compile(r"\S+")
+
+
+def _paragraph_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) of each stripped, non-empty paragraph of text."""
+    spans = []
+    pos = 0
+    for raw in text.split("\n\n"):
+        stripped = raw.strip()
+        if stripped:
+            s = pos + len(raw) - len(raw.lstrip())
+            spans.append((s, s + len(stripped)))
+        pos += len(raw) + 2
+    return spans
+
+
+def _sentence_spans(text: str, start: int, end: int) -> List[Tuple[int, int]]:
+    spans = []
+    pos = start
+    for m in _SENTENCE_SPLIT_RE.finditer(text, start, end):
+        spans.append((pos, m.start()))
+        pos = m.end()
+    spans.append((pos, end))
+    return spans
+
+
+class ParagraphChunker:
+    """
+    Incremental paragraph chunker. feed() takes consecutive stripped page texts (joined
+    with PARAGRAPH_JOINER in the document) and returns the chunks completed so far, so
+    chunking runs while later pages are still being extracted. Only the text of the chunk
+    being built is buffered. Each chunk is (text, n_tokens, start, end) with document offsets.
+    """
+
+    def __init__(self, target_tokens: int = 1000, overlap_tokens: int = 100):
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+        self.joiner_tokens = count_tokens(PARAGRAPH_JOINER)
+        self.length = 0  # characters of the document fed so far
+        self._buf = ""  # document text from self._base to self.length
+        self._base = 0
+        self._cur: List[str] = []
+        self._cur_tok = 0
+        self._cur_start = self._cur_end = 0
+        self._out: List[Tuple[str, int, int, int]] = []
+
+    def next_offset(self) -> int:
+        """Document offset at which the next fed text will start."""
+        return self.length + len(PARAGRAPH_JOINER) if self.length else 0
+
+    def feed(self, text: str) -> List[Tuple[str, int, int, int]]:
+        if not text:
+            return []
+        offset = self.next_offset()
+        self._buf += (PARAGRAPH_JOINER + text) if self.length else text
+        self.length = offset + len(text)
+
+        para_spans = [(offset + s, offset + e) for s, e in _paragraph_spans(text)]
+        paragraphs = [text[s - offset:e - offset] for s, e in para_spans]
+        for p, ptoks, pspan in zip(paragraphs, count_tokens_batch(paragraphs), para_spans):
+            if ptoks > self.target_tokens * 1.5:
+                # very large paragraph; split by sentences as a fallback
+                sent_spans = [(offset + s, offset + e) for s, e in _sentence_spans(text, pspan[0] - offset, pspan[1] - offset)]
+                sentences = [text[s - offset:e - offset] for s, e in sent_spans]
+                for sent, stoks, sspan in zip(sentences, count_tokens_batch(sentences), sent_spans):
+                    self._add(sent, stoks, sspan)
+                continue
+            self._add(p, ptoks, pspan)
+
+        # everything before the current chunk's start is no longer needed
+        keep_from = self._cur_start if self._cur else self.length
+        if keep_from > self._base:
+            self._buf = self._buf[keep_from - self._base:]
+            self._base = keep_from
+        return self._drain()
+
+    def finish(self) -> List[Tuple[str, int, int, int]]:
+        if self._cur:
+            self._flush()
+            self._cur = []
+        return self._drain()
+
+    def _drain(self) -> List[Tuple[str, int, int, int]]:
+        # final cleanup
+        out = [c for c in self._out if c[0] and len(c[0].split()) >= 5]
+        self._out = []
+        return out
+
+    def _add(self, part: str, ptoks: int, span: Tuple[int, int]) -> None:
+        if self._cur_tok + ptoks > self.target_tokens and self._cur:
+            self._flush()
+        if not self._cur:
+            self._cur_start = span[0]
+        self._cur.append(part)
+        self._cur_tok += ptoks
+        self._cur_end = span[1]
+
+    def _flush(self) -> None:
+        chunk = PARAGRAPH_JOINER.join(self._cur).strip()
+        self._out.append((chunk, self._cur_tok + self.joiner_tokens * (len(self._cur) - 1), self._cur_start, self._cur_end))
+        # start next window with minimal overlap (last chunk tail)
+        if self.overlap_tokens > 0 and chunk:
+            words = chunk.split()[-self.overlap_tokens:]
+            tail_start = self._cur_end
+            matches = _NON_SPACE_RE.finditer(self._buf, self._cur_start - self._base, self._cur_end - self._base)
+            for m, _ in zip(reversed(list(matches)), words):
+                tail_start = m.start() + self._base
+            tail = " ".join(words)
+            self._cur, self._cur_tok, self._cur_start = [tail], count_tokens(tail), tail_start
+        else:
+            self._cur, self._cur_tok = [], 0
+
+
+def chunk_text_with_spans(text: str, target_tokens: int = 1000, overlap_tokens: int = 100) -> List[Tuple[str, int, int, int]]:
+    """
+    Token-aware chunker that tries to break on paragraph boundaries.
+    Returns (chunk, n_tokens, start, end) where text[start:end] is the source region the
+    chunk (including its overlap tail) was taken from. Paragraphs (and sentences of oversized
+    paragraphs) are tokenized once in a batch and the per-part counts are summed.
+    """
+    chunker = ParagraphChunker(target_tokens, overlap_tokens)
+    return chunker.feed(text) + chunker.finish()
+
+
+def chunk_text(text: str, target_tokens: int = 1000, overlap_tokens: int = 100) -> List[str]:
+    """Simple token-aware chunker that tries to break on paragraph boundaries."""
+    return [c[0] for c in chunk_text_with_spans(text, target_tokens, overlap_tokens)]
+
+
+_PARAGRAPH_BREAK_RE = re.compile(r"\n\n+")
+_SENTENCE_BREAK_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _boundary_tokens(pattern: "re.Pattern", text: str, offsets: array, use_end: bool) -> List[int]:
+    """Token indices whose token starts at (or right after) each regex boundary in text."""
+    out = []
+    for m in pattern.finditer(text):
+        t = bisect_left(offsets, m.end() if use_end else m.start())
+        if 0 < t < len(offsets) and (not out or out[-1] != t):
+            out.append(t)
+    return out
+
+
+def _last_boundary(boundaries: List[int], lo: int, hi: int) -> Optional[int]:
+    i = bisect_right(boundaries, hi) - 1
+    if i >= 0 and boundaries[i] >= lo:
+        return boundaries[i]
+    return None
+
+
+def chunk_tokens(text: str, target_tokens: int = 1000, overlap_tokens: int = 100,
+                 boundary_tolerance: float = 0.1, pack: bool = False) -> List[Tuple[str, int, int, int]]:
+    """
+    Sliding-window chunker over the token ids of the whole document.
+    Each window holds at most target_tokens tokens and the next one starts exactly
+    overlap_tokens before its end. A window may end up to boundary_tolerance * target_tokens
+    early to land on a paragraph break (or else a sentence break).
+    With pack=True boundaries are ignored and every window, including the last one,
+    is exactly target_tokens long (when the document has that many tokens).
+    """
+    if target_tokens < 1:
+        raise ValueError(f"target_tokens must be at least 1, got {target_tokens}")
+    ids, offsets = encode_with_offsets(text)
+    n = len(ids)
+    if n == 0:
+        return []
+    overlap = max(0, min(overlap_tokens, target_tokens - 1))
+    tolerance = int(target_tokens * boundary_tolerance)
+    paragraphs = [] if pack else _boundary_tokens(_PARAGRAPH_BREAK_RE, text, offsets, use_end=True)
+    sentences = [] if pack else _boundary_tokens(_SENTENCE_BREAK_RE, text, offsets, use_end=False)
+
+    windows: List[Tuple[int, int]] = []
+    start = 0
+    while True:
+        end = min(start + target_tokens, n)
+        if end < n and not pack:
+            lo = max(start + overlap + 1, end - tolerance)
+            b = _last_boundary(paragraphs, lo, end)
+            if b is None:
+                b = _last_boundary(sentences, lo, end)
+            if b is not None:
+                end = b
+        elif end == n and pack:
+            # fill the tail window by sliding it back over already-seen tokens
+            start = max(0, n - target_tokens)
+        windows.append((start, end))
+        if end >= n:
+            break
+        start = end - overlap
+
+    chunks: List[Tuple[str, int, int, int]] = []
+    for s, e in windows:
+        cs, ce = offsets[s], offsets[e] if e < n else len(text)
+        raw = text[cs:ce]
+        chunk = raw.strip()
+        if chunk and len(chunk.split()) >= 5:
+            cs += len(raw) - len(raw.lstrip())
+            chunks.append((chunk, e - s, cs, cs + len(chunk)))
+    return chunks
+
+
+CHUNKERS = ("paragraph", "token", "pack")
+
+
+def chunk_document(text: str, target_tokens: int, overlap_tokens: int,
+                   chunker: str = "paragraph") -> List[Tuple[str, int, int, int]]:
+    """Dispatch to the selected chunker; returns (chunk, n_tokens, source start, source end)."""
+    if chunker == "paragraph":
+        return chunk_text_with_spans(text, target_tokens=target_tokens, overlap_tokens=overlap_tokens)
+    if chunker in ("token", "pack"):
+        return chunk_tokens(text, target_tokens=target_tokens, overlap_tokens=overlap_tokens, pack=chunker == "pack")
+    raise ValueError(f"Unknown chunker: {chunker}")
+
+
+# ---------------- Quality scoring
+QUALITY_FIELDS = ("alpha_ratio", "mean_word_len", "repeat_ngram_frac", "line_len_cv", "lang_conf")
+_UNSCORED = (float("nan"),) * len(QUALITY_FIELDS)
+
+_ALPHA_RE = re.compile(r"[^\W\d_]")
+_WORD_RE = re.compile(r"\w+")
+# Common English function words; their share of all words is a cheap, offline language-ID signal
+_EN_FUNCTION_WORDS = frozenset("""
+a about after all also an and any are as at be because been but by can could do does each for from had
+has have he her his how if in into is it its may more most must no not of on one or other our out over
+she should so some such than that the their them then there these they this those through to under up
+use used was we were what when where which while who will with would you your
+""".split())
+# typical English prose has ~40% function words; scores are scaled so that reads as 1.0
+_EN_FUNCTION_WORD_SHARE = 0.4
+
+
+def quality_scores(texts: List[str]) -> List[Tuple[float, ...]]:
+    """
+    Quality features for each of a document's chunk texts, in QUALITY_FIELDS order:
+    alpha_ratio (letters / non-space chars), mean_word_len, repeat_ngram_frac (share of
+    word 3-grams that repeat), line_len_cv (std / mean of line lengths; tables and
+    symbol soup score high) and lang_conf (English function-word share, capped at 1).
+    Runs in the worker processes right after chunking. Texts are scored one at a time
+    (nothing is vectorized across them); within a text each feature is a regex, len or
+    set over its words, not a Python loop per character.
+    """
+    out = []
+    for text in texts:
+        words = text.split()
+        n_words = len(words)
+        n_chars = sum(map(len, words))
+        lower = _WORD_RE.findall(text.lower())
+        n_trigrams = len(lower) - 2
+        line_lens = [len(l) for l in text.splitlines() if l.strip()]
+        if len(line_lens) > 1:
+            mean = sum(line_lens) / len(line_lens)
+            line_cv = (sum((n - mean) ** 2 for n in line_lens) / len(line_lens)) ** 0.5 / mean
+        else:
+            line_cv = 0.0
+        out.append((
+            round(len(_ALPHA_RE.findall(text)) / n_chars, 4) if n_chars else 0.0,
+            round(n_chars / n_words, 4) if n_words else 0.0,
+            round(1.0 - len(set(zip(lower, lower[1:], lower[2:]))) / n_trigrams, 4) if n_trigrams > 0 else 0.0,
+            round(line_cv, 4),
+            round(min(1.0, sum(w in _EN_FUNCTION_WORDS for w in lower) / len(lower) / _EN_FUNCTION_WORD_SHARE), 4)
+            if lower else 0.0,
+        ))
+    return out
+
+
+@dataclass
+class QualityFilter:
+    """Thresholds on quality_scores(); None disables a check. Unscored chunks always pass."""
+    min_alpha_ratio: Optional[float] = 0.6
+    min_mean_word_len: Optional[float] = 2.5
+    max_mean_word_len: Optional[float] = 12.0
+    max_repeat_ngram_frac: Optional[float] = 0.5
+    max_line_len_cv: Optional[float] = None
+    min_lang_conf: Optional[float] = None
+
+    def passes(self, quality: Tuple[float, ...]) -> bool:
+        if not quality:
+            return True
+        alpha, mean_len, repeat, line_cv, lang = quality
+        return not (
+            (self.min_alpha_ratio is not None and alpha < self.min_alpha_ratio)
+            or (self.min_mean_word_len is not None and mean_len < self.min_mean_word_len)
+            or (self.max_mean_word_len is not None and mean_len > self.max_mean_word_len)
+            or (self.max_repeat_ngram_frac is not None and repeat > self.max_repeat_ngram_frac)
+            or (self.max_line_len_cv is not None and line_cv > self.max_line_len_cv)
+            or (self.min_lang_conf is not None and lang < self.min_lang_conf)
+        )
+
+
+# ---------------- Dedupe
+
+
+def word_set(text: str) -> set:
+    return set(w.lower() for w in _WORD_RE.findall(text))
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / max(1, len(a | b))
+
+
+class ExactDedupeIndex:
+    """Original all-pairs word-set Jaccard check. O(n) per chunk, O(n^2) per run."""
+
+    def __init__(self, min_jaccard: float = 0.9):
+        self.min_jaccard = min_jaccard
+        self.signatures: List[set] = []
+
+    def add_if_new(self, words: set) -> bool:
+        for sig in self.signatures:
+            if jaccard(words, sig) >= self.min_jaccard:
+                return False
+        self.signatures.append(words)
+        return True
+
+
+class MinHashLSHIndex:
+    """
+    MinHash signatures + LSH banding. Only chunks sharing at least one band bucket are
+    compared, and candidates are verified with the exact Jaccard so results never include
+    false positives. With 16 bands of 8 rows a pair at Jaccard 0.9 collides with p > 0.999.
+    """
+
+    def __init__(self, min_jaccard: float = 0.9, num_perm: int = 128, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.min_jaccard = min_jaccard
+        self.bands = bands
+        self.rows = num_perm // bands
+        np = self._np = _numpy()
+        self._prime = np.uint64((1 << 61) - 1)
+        self._max_hash = np.uint64(0xFFFFFFFF)
+        rng = np.random.RandomState(seed)
+        # (a * x + b) mod p stays below 2**64 because a, b and x are all 32-bit
+        self._a = rng.randint(1, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self.buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(bands)]
+        self.signatures: List[set] = []
+
+    def minhash(self, words: set):
+        np = self._np
+        hv = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype=np.uint64, count=len(words))
+        phv = (self._a * hv + self._b) % self._prime & self._max_hash
+        return phv.min(axis=1).astype(np.uint32)
+
+    def add_if_new(self, words: set) -> bool:
+        if not words:
+            return True
+        sig = self.minhash(words)
+        keys = [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        seen = set()
+        for band, key in zip(self.buckets, keys):
+            for cand in band.get(key, ()):
+                if cand in seen:
+                    continue
+                seen.add(cand)
+                if jaccard(words, self.signatures[cand]) >= self.min_jaccard:
+                    return False
+        idx = len(self.signatures)
+        self.signatures.append(words)
+        for band, key in zip(self.buckets, keys):
+            band[key].append(idx)
+        return True
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_np"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._np = _numpy()
+
+
+def make_dedupe_index(method: str = "minhash", min_jaccard: float = 0.9):
+    if method == "minhash" and _numpy() is not None:
+        return MinHashLSHIndex(min_jaccard)
+    if method not in ("minhash", "exact"):
+        raise ValueError(f"Unknown dedupe method: {method}")
+    # exact is also the fallback when numpy is not installed
+    return ExactDedupeIndex(min_jaccard)
+
+
+def dedupe_chunks(chunks: Iterable[Chunk], min_jaccard: float = 0.9, method: str = "minhash") -> List[Chunk]:
+    """Near-duplicate removal using Jaccard similarity on word sets (first occurrence wins)."""
+    index = make_dedupe_index(method, min_jaccard)
+    return [ch for ch in chunks if index.add_if_new(word_set(ch.text))]
+
+
+@lru_cache(maxsize=1 << 20)
+def _word_hash(word: str) -> int:
+    return zlib.crc32(word.encode("utf-8"))
+
+
+class HashingEmbedder:
+    """
+    Offline fallback embedder: signed feature hashing of word unigrams and bigrams with
+    sublinear term frequency, L2-normalized. Catches reflowed and lightly edited text,
+    not true paraphrases.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed(self, texts: List[str]):
+        np = _numpy()
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORD_RE.findall(text.lower())
+            if not words:
+                continue
+            uni = np.fromiter(map(_word_hash, words), dtype=np.uint64, count=len(words))
+            # bigram features are hashed from the two word hashes instead of a joined string
+            h = np.concatenate([uni, (uni[:-1] * 1000003 + uni[1:]) & 0xFFFFFFFF])
+            signs = np.where(h & 0x80000000, -1.0, 1.0)
+            out[row] = np.bincount((h & 0x7FFFFFFF) % self.dim, weights=signs, minlength=self.dim)
+        out = np.sign(out) * np.log1p(np.abs(out))
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedding model via sentence-transformers (name or path), L2-normalized."""
+
+    def __init__(self, model_name: str, batch_size: int = 64):
+        st = _sentence_transformers()
+        if st is None:
+            raise RuntimeError("Semantic dedupe with a model needs sentence-transformers "
+                               "(pip install sentence-transformers), or use the 'hashing' embedder.")
+        self.model = st.SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]):
+        vecs = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        return vecs.astype(_numpy().float32)
+
+
+class SemanticDedupeIndex:
+    """
+    Drops chunks whose embedding has cosine similarity >= threshold with an earlier kept
+    chunk. Vectors are kept in one growable float32 matrix. Random-hyperplane LSH (bands of
+    sign bits, like MinHashLSHIndex) picks candidates, which are then verified with exact
+    cosine in a single matrix product, so a query never scans the whole matrix. With 32
+    bands of 16 bits a pair at cosine 0.92 collides with p > 0.97, while unrelated chunks
+    (cosine ~0) share a bucket with p ~ 0.0005.
+    """
+
+    def __init__(self, embedder, threshold: float = 0.92, bands: int = 32, rows: int = 16, seed: int = 1):
+        self._np = _numpy()
+        self.embedder = embedder
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+        self._planes = None  # created on the first batch, once the embedding size is known
+        self.vectors = None
+        self.size = 0
+        self.buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(bands)]
+
+    def _band_keys(self, vecs) -> List[List[bytes]]:
+        np = self._np
+        if self._planes is None:
+            rng = np.random.RandomState(self.seed)
+            self._planes = rng.standard_normal((vecs.shape[1], self.bands * self.rows)).astype(np.float32)
+            self.vectors = np.zeros((1024, vecs.shape[1]), dtype=np.float32)
+        bits = (vecs @ self._planes > 0).reshape(len(vecs), self.bands, self.rows)
+        packed = np.packbits(bits, axis=2)
+        return [[band.tobytes() for band in row] for row in packed]
+
+    def _append(self, vec, keys: List[bytes]) -> None:
+        if self.size == len(self.vectors):
+            grown = self._np.zeros((2 * len(self.vectors), self.vectors.shape[1]), dtype=self.vectors.dtype)
+            grown[:self.size] = self.vectors
+            self.vectors = grown
+        self.vectors[self.size] = vec
+        for band, key in zip(self.buckets, keys):
+            band[key].append(self.size)
+        self.size += 1
+
+    def add_batch(self, texts: List[str]) -> List[bool]:
+        """Embed texts in one batch; returns a keep flag per text (earlier texts in the batch count)."""
+        if not texts:
+            return []
+        np = self._np
+        vecs = self.embedder.embed(texts)
+        keep = []
+        for vec, keys in zip(vecs, self._band_keys(vecs)):
+            cands = set()
+            for band, key in zip(self.buckets, keys):
+                cands.update(band.get(key, ()))
+            if cands:
+                idx = np.fromiter(cands, dtype=np.int64, count=len(cands))
+                if float((self.vectors[idx] @ vec).max()) >= self.threshold:
+                    keep.append(False)
+                    continue
+            self._append(vec, keys)
+            keep.append(True)
+        return keep
+
+    def __getstate__(self):
+        # the embedder (possibly a loaded model) is reattached by DedupeCheckpoint.load
+        state = dict(self.__dict__)
+        del state["_np"]
+        state["embedder"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._np = _numpy()
+
+
+def semantic_available(embedder: str) -> bool:
+    return _numpy() is not None and (embedder == "hashing" or _sentence_transformers() is not None)
+
+
+def make_semantic_index(embedder: Optional[str], threshold: float = 0.92) -> Optional[SemanticDedupeIndex]:
+    """'hashing' for the offline HashingEmbedder, anything else is a sentence-transformers model."""
+    if not embedder:
+        return None
+    if _numpy() is None:
+        raise RuntimeError("Semantic dedupe needs numpy (pip install numpy).")
+    model = HashingEmbedder() if embedder == "hashing" else SentenceTransformerEmbedder(embedder)
+    return SemanticDedupeIndex(model, threshold)
+
+
+# Bump whenever cleaning/chunking output changes so stale cache entries are not reused
+PIPELINE_VERSION = 5
+
+
+class BuildCache:
+    """
+    On-disk content-addressed cache for extracted pages and chunk lists.
+    Entries are JSON files named by a sha256 key; hits refresh the mtime and
+    evict() drops least recently used entries until the cache fits max_bytes.
+    Writes go through a temp file + rename so concurrent workers never see partial entries.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, kind: str, key: str) -> str:
+        return os.path.join(self.root, kind, key[:2], key + ".json")
+
+    def get(self, kind: str, key: str):
+        path = self._path(kind, key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, kind: str, key: str, value) -> None:
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def evict(self) -> int:
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+class Metrics:
+    """
+    Per-stage wall/CPU timers, counters and per-document timings for one build.
+    Worker processes fill their own instance per document and the parent merge()s them,
+    so totals are the same with any --workers. Tokenization is timed as part of "chunk".
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, List[float]] = {}  # name -> [wall seconds, cpu seconds, calls]
+        self.counters: Counter = Counter()
+        self.gauges: Dict[str, float] = {}
+        self.documents: List[dict] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, [0.0, 0.0, 0])
+            entry[0] += time.perf_counter() - wall
+            entry[1] += time.process_time() - cpu
+            entry[2] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def merge(self, other: "Metrics") -> None:
+        for name, (wall, cpu, calls) in other.stages.items():
+            entry = self.stages.setdefault(name, [0.0, 0.0, 0])
+            entry[0] += wall
+            entry[1] += cpu
+            entry[2] += calls
+        self.counters.update(other.counters)
+        self.gauges.update(other.gauges)
+        self.documents.extend(other.documents)
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": {name: {"wall_seconds": round(w, 6), "cpu_seconds": round(c, 6), "calls": n}
+                       for name, (w, c, n) in self.stages.items()},
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "documents": self.documents,
+        }
+
+    def to_prometheus(self, prefix: str = "cpt_build") -> str:
+        """Prometheus text exposition format (e.g. for the node_exporter textfile collector)."""
+        out = []
+
+        def family(name: str, mtype: str, help_text: str, samples: List[Tuple[str, float]]):
+            out.append(f"# HELP {prefix}_{name} {help_text}")
+            out.append(f"# TYPE {prefix}_{name} {mtype}")
+            for labels, value in samples:
+                out.append(f"{prefix}_{name}{labels} {value}")
+
+        stages = sorted(self.stages.items())
+        family("stage_wall_seconds_total", "counter", "Wall time spent in each pipeline stage.",
+               [(f'{{stage="{k}"}}', round(v[0], 6)) for k, v in stages])
+        family("stage_cpu_seconds_total", "counter", "CPU time spent in each pipeline stage.",
+               [(f'{{stage="{k}"}}', round(v[1], 6)) for k, v in stages])
+        family("stage_calls_total", "counter", "Number of times each stage ran.",
+               [(f'{{stage="{k}"}}', v[2]) for k, v in stages])
+        for name, value in sorted(self.counters.items()):
+            family(f"{name}_total", "counter", f"Total {name.replace('_', ' ')}.", [("", value)])
+        for name, value in sorted(self.gauges.items()):
+            family(name, "gauge", f"{name.replace('_', ' ').capitalize()}.", [("", value)])
+        doc_seconds = [d["seconds"] for d in self.documents]
+        family("document_seconds", "summary", "Per-document processing wall time.",
+               [("_sum", round(sum(doc_seconds), 6)), ("_count", len(doc_seconds))])
+        return "\n".join(out) + "\n"
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def join_pages(page_texts: List[Tuple[int, str]]) -> Tuple[str, List[int], List[int]]:
+    """Join page texts with paragraph breaks; also return each page's start offset in the result."""
+    starts: List[int] = []
+    numbers: List[int] = []
+    pos = 0
+    for pno, t in page_texts:
+        starts.append(pos)
+        numbers.append(pno)
+        pos += len(t) + len(PARAGRAPH_JOINER)
+    return PARAGRAPH_JOINER.join(t for _, t in page_texts), starts, numbers
+
+
+def page_span(page_starts: List[int], page_numbers: List[int], start: int, end: int) -> Tuple[int, int]:
+    """First and last page covering text[start:end], in O(log pages)."""
+    if not page_starts:
+        return 1, 1
+    first = max(0, bisect_right(page_starts, start) - 1)
+    last = max(first, bisect_right(page_starts, max(start, end - 1)) - 1)
+    return page_numbers[first], page_numbers[last]
+
+
+def clean_pages(pages: Iterator[Tuple[int, str]], drop: Optional[set] = None,
+                metrics: Optional[Metrics] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Lazily strip headers/footers (lines in drop, plus page-number lines) and basic_clean each
+    page, yielding only non-empty cleaned pages. drop=None leaves lines untouched.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    for pno, ptxt in pages:
+        if drop is not None:
+            with metrics.stage("strip_headers"):
+                ptxt = strip_lines(ptxt, drop, check_page_numbers=True)
+        with metrics.stage("clean"):
+            cleaned = basic_clean(ptxt)
+        if cleaned:
+            yield pno, cleaned
+
+
+def chunk_pages(page_texts: Iterator[Tuple[int, str]], target_tokens: int, overlap_tokens: int,
+                chunker: str = "paragraph", metrics: Optional[Metrics] = None
+                ) -> Tuple[List[Tuple[str, int, int, int]], List[int], List[int], int]:
+    """
+    Chunk cleaned pages, returning (chunks, page_starts, page_numbers, n_chars) for page_span.
+    The paragraph chunker is fed page by page as pages arrive; the token chunkers need the
+    whole document text.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    if chunker != "paragraph":
+        page_texts = list(page_texts)
+        with metrics.stage("clean"):
+            full_text, page_starts, page_numbers = join_pages(page_texts)
+        del page_texts
+        with metrics.stage("chunk"):
+            return chunk_document(full_text, target_tokens, overlap_tokens, chunker), page_starts, page_numbers, len(full_text)
+
+    pc = ParagraphChunker(target_tokens, overlap_tokens)
+    doc_chunks: List[Tuple[str, int, int, int]] = []
+    page_starts: List[int] = []
+    page_numbers: List[int] = []
+    for pno, text in page_texts:
+        page_starts.append(pc.next_offset())
+        page_numbers.append(pno)
+        with metrics.stage("chunk"):
+            doc_chunks += pc.feed(text)
+    with metrics.stage("chunk"):
+        doc_chunks += pc.finish()
+    return doc_chunks, page_starts, page_numbers, pc.length
+
+
+def _timed_pages(pages: Iterator[Tuple[int, str]], metrics: Metrics) -> Iterator[Tuple[int, str]]:
+    """Attribute the time spent producing each page to the extract stage."""
+    while True:
+        with metrics.stage("extract"):
+            page = next(pages, None)
+        if page is None:
+            return
+        yield page
+
+
+def process_document(fp: str, target_tokens: int, overlap_tokens: int, rm_headers: bool,
+                     cache: Optional[BuildCache] = None, chunker: str = "paragraph",
+                     metrics: Optional[Metrics] = None, page_batch: int = 256,
+                     fingerprint: Optional[dict] = None) -> List[Chunk]:
+    """
+    Extract, clean and chunk a single PDF. Runs in a worker process when --workers > 1.
+    Header/footer detection samples pages first (SampledHeaderDetector); pages are then
+    stripped, cleaned and chunked one at a time. Documents with up to page_batch pages are
+    extracted once and held (and cached); longer ones are streamed lazily from the mmap.
+    If given, fingerprint is filled with PdfSource.fingerprint() of the bytes actually read.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    started = time.perf_counter()
+    doc_name = os.path.basename(fp)
+    with PdfSource(fp) as src:
+        if fingerprint is not None:
+            fingerprint.update(src.fingerprint())
+        cached_chunks = cached_pages = None
+        if cache is not None:
+            with metrics.stage("cache"):
+                content_hash = src.content_hash()
+                backend = extractor_backend()
+                chunks_key = BuildCache.key(PIPELINE_VERSION, content_hash, backend, tokenizer_name(), rm_headers,
+                                            target_tokens, overlap_tokens, chunker)
+                cached_chunks = cache.get("chunks", chunks_key)
+                if cached_chunks is None:
+                    pages_key = BuildCache.key(PIPELINE_VERSION, content_hash, backend)
+                    cached_pages = cache.get("pages", pages_key)
+        if cached_chunks is not None:
+            chunks = [Chunk(doc_name=doc_name, index=idx, text=text, pages=(pmin, pmax), n_tokens=n_tokens,
+                            quality=tuple(quality))
+                      for idx, (text, pmin, pmax, n_tokens, quality) in enumerate(cached_chunks)]
+            metrics.count("documents_cached")
+            _record_document(metrics, doc_name, None, None, chunks, started, cached=True)
+            return chunks
+
+        pages: Optional[List[Tuple[int, str]]] = None
+        if cached_pages is not None:
+            pages = [(pno, text) for pno, text in cached_pages]
+            n_pages = len(pages)
+        else:
+            with metrics.stage("extract"):
+                n_pages = src.page_count
+            if n_pages <= page_batch:
+                pages = list(_timed_pages(src.iter_pages(), metrics))
+                if cache is not None:
+                    with metrics.stage("cache"):
+                        cache.put("pages", pages_key, pages)
+
+        drop = None
+        if rm_headers:
+            # pass 1: line frequencies over a sample of pages
+            sample = sample_page_indices(n_pages)
+            detector = SampledHeaderDetector(len(sample))
+            for i in sample:
+                if pages is not None:
+                    text = pages[i][1]
+                else:
+                    with metrics.stage("extract"):
+                        text = src.page_text(i)
+                with metrics.stage("strip_headers"):
+                    detector.observe(text)
+            drop = detector.repeated()
+
+        # pass 2: extract (unless held), strip, clean and chunk one page at a time
+        raw_pages = iter(pages) if pages is not None else _timed_pages(src.iter_pages(), metrics)
+        del pages
+        doc_chunks, page_starts, page_numbers, n_chars = chunk_pages(
+            clean_pages(raw_pages, drop, metrics), target_tokens, overlap_tokens, chunker, metrics)
+
+    with metrics.stage("quality"):
+        scores = quality_scores([c[0] for c in doc_chunks])
+    # chunkers report exact source spans for the audit page range
+    chunks: List[Chunk] = []
+    for idx, ((text, n_tokens, span_start, span_end), quality) in enumerate(zip(doc_chunks, scores)):
+        pmin, pmax = page_span(page_starts, page_numbers, span_start, span_end)
+        chunks.append(Chunk(
+            doc_name=doc_name,
+            index=idx,
+            text=text,
+            pages=(pmin, pmax),
+            n_tokens=n_tokens,
+            quality=quality,
+        ))
+    if cache is not None:
+        with metrics.stage("cache"):
+            cache.put("chunks", chunks_key, [[ch.text, ch.pages[0], ch.pages[1], ch.n_tokens, list(ch.quality)]
+                                             for ch in chunks])
+    _record_document(metrics, doc_name, n_pages, n_chars, chunks, started, cached=False)
+    return chunks
+
+
+def _record_document(metrics: Metrics, doc_name: str, n_pages: Optional[int], n_chars: Optional[int],
+                     chunks: List[Chunk], started: float, cached: bool) -> None:
+    n_tokens = sum(ch.n_tokens for ch in chunks)
+    metrics.count("documents")
+    metrics.count("chunks", len(chunks))
+    metrics.count("tokens", n_tokens)
+    if n_pages is not None:
+        metrics.count("pages", n_pages)
+        metrics.count("chars", n_chars)
+    metrics.documents.append({
+        "file": doc_name,
+        "pages": n_pages,
+        "chars": n_chars,
+        "chunks": len(chunks),
+        "tokens": n_tokens,
+        "cached": cached,
+        "seconds": round(time.perf_counter() - started, 6),
+    })
+
+
+def _process_document_args(args: Tuple[str, int, int, bool, Optional[BuildCache], str, int]) -> Tuple[List[Chunk], Metrics, dict]:
+    fp, target_tokens, overlap_tokens, rm_headers, cache, chunker, page_batch = args
+    metrics = Metrics()
+    fingerprint: dict = {}
+    chunks = process_document(fp, target_tokens, overlap_tokens, rm_headers, cache, chunker, metrics, page_batch, fingerprint)
+    return chunks, metrics, fingerprint
+
+
+def iter_document_chunks(file_paths: List[str], target_tokens: int, overlap_tokens: int, rm_headers: bool,
+                         workers: int = 1, cache: Optional[BuildCache] = None,
+                         chunker: str = "paragraph", metrics: Optional[Metrics] = None,
+                         page_batch: int = 256, pool: Optional[ProcessPoolExecutor] = None) -> Iterator[Tuple[List[Chunk], dict]]:
+    """
+    Yield each document's (chunks, input fingerprint) in input order, fanning out to a process
+    pool if workers > 1. The fingerprint is taken by the worker as it reads the file.
+    A long-lived pool (created with initializer=warm_up) is used instead of a new one if given.
+    """
+    jobs = [(fp, target_tokens, overlap_tokens, rm_headers, cache, chunker, page_batch) for fp in file_paths]
+    if workers <= 1 or len(jobs) <= 1:
+        for fp in file_paths:
+            fingerprint: dict = {}
+            yield process_document(fp, target_tokens, overlap_tokens, rm_headers, cache, chunker, metrics, page_batch,
+                                   fingerprint), fingerprint
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up) if pool is None else nullcontext(pool) as pool:
+        # Keep a bounded window of documents in flight and yield in submission order,
+        # so chunk ids match a serial run and finished-but-unwritten results stay small.
+        pending = deque()
+        jobs_iter = iter(jobs)
+        for job in jobs_iter:
+            pending.append(pool.submit(_process_document_args, job))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            doc_chunks, doc_metrics, fingerprint = pending.popleft().result()
+            if metrics is not None:
+                metrics.merge(doc_metrics)
+            job = next(jobs_iter, None)
+            if job is not None:
+                pending.append(pool.submit(_process_document_args, job))
+            yield doc_chunks, fingerprint
+
+
+def iter_dataset(file_paths: List[str], target_tokens: int, overlap_tokens: int, rm_headers: bool,
+                 dedupe_index=None, workers: int = 1, cache: Optional[BuildCache] = None,
+                 start_index: int = 0, chunker: str = "paragraph", metrics: Optional[Metrics] = None,
+                 page_batch: int = 256, semantic_index: Optional[SemanticDedupeIndex] = None,
+                 quality_filter: Optional[QualityFilter] = None,
+                 pool: Optional[ProcessPoolExecutor] = None) -> Iterator[Tuple[str, List[Chunk], int, dict]]:
+    """
+    Stream (path, kept chunks, next chunk id, input fingerprint) per document. Chunk ids are
+    global and count dropped chunks too. Chunks failing quality_filter are dropped first; dedupe checks each
+    remaining chunk against everything emitted before it, and chunks surviving the lexical
+    dedupe go through semantic_index one document per batch.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    next_index = start_index
+    doc_iter = iter_document_chunks(file_paths, target_tokens, overlap_tokens, rm_headers, workers, cache, chunker, metrics,
+                                    page_batch, pool)
+    for fp, (doc_chunks, fingerprint) in zip(file_paths, doc_iter):
+        kept = []
+        low_quality = 0
+        with metrics.stage("dedupe"):
+            for ch in doc_chunks:
+                ch.index = next_index
+                next_index += 1
+                if quality_filter is not None and not quality_filter.passes(ch.quality):
+                    low_quality += 1
+                elif dedupe_index is None or dedupe_index.add_if_new(word_set(ch.text)):
+                    kept.append(ch)
+        metrics.count("low_quality_dropped", low_quality)
+        metrics.count("duplicates_dropped", len(doc_chunks) - low_quality - len(kept))
+        if semantic_index is not None and kept:
+            with metrics.stage("semantic_dedupe"):
+                flags = semantic_index.add_batch([ch.text for ch in kept])
+            metrics.count("semantic_duplicates_dropped", flags.count(False))
+            kept = [ch for ch, keep in zip(kept, flags) if keep]
+        metrics.count("chunks_kept", len(kept))
+        metrics.count("tokens_kept", sum(ch.n_tokens for ch in kept))
+        yield fp, kept, next_index, fingerprint
+
+
+AUDIT_HEADER = "chunk_id,doc_name,page_start,page_end,approx_tokens," + ",".join(QUALITY_FIELDS)
+
+
+def jsonl_line(ch: Chunk) -> str:
+    return json.dumps({"text": ch.text}, ensure_ascii=False)
+
+
+def audit_line(ch: Chunk) -> str:
+    quality = ",".join(map(str, ch.quality)) if ch.quality else "," * (len(QUALITY_FIELDS) - 1)
+    return f"{ch.index},{ch.doc_name},{ch.pages[0]},{ch.pages[1]},{ch.n_tokens},{quality}"
+
+
+def parse_audit_line(line: str) -> Tuple[int, str, int, int, int, Tuple[float, ...]]:
+    """Inverse of audit_line (doc names may contain commas; the numeric fields cannot)."""
+    chunk_id, rest = line.rstrip("\n").split(",", 1)
+    doc_name, page_start, page_end, n_tokens, *quality = rest.rsplit(",", 3 + len(QUALITY_FIELDS))
+    scores = tuple(float(v) for v in quality) if all(quality) else ()
+    return int(chunk_id), doc_name, int(page_start), int(page_end), int(n_tokens), scores
+
+
+class ArrowDatasetWriter:
+    """
+    Writes ChunkStore batches as an Arrow IPC file (memory-mappable, e.g. .arrow) or, for
+    a .parquet path, as Parquet row groups. Needs pyarrow. Columns mirror dataset.jsonl
+    plus audit.csv: text, chunk_id, doc_name, page_start, page_end, approx_tokens and the
+    QUALITY_FIELDS scores (NaN when unscored).
+    """
+
+    def __init__(self, path: str):
+        pa = self.pa = _pyarrow()
+        if pa is None:
+            raise RuntimeError("Arrow/Parquet output needs pyarrow (pip install pyarrow).")
+        self.path = path
+        self.schema = pa.schema([
+            ("text", pa.large_string()),
+            ("chunk_id", pa.int64()),
+            ("doc_name", pa.string()),
+            ("page_start", pa.int32()),
+            ("page_end", pa.int32()),
+            ("approx_tokens", pa.int32()),
+        ] + [(name, pa.float64()) for name in QUALITY_FIELDS])
+        if path.endswith(".parquet"):
+            self._writer = pa.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self._writer = pa.ipc.new_file(path, self.schema)
+
+    def _ints(self, type_, values: array):
+        # zero-copy view of the array's buffer
+        return self.pa.Array.from_buffers(type_, len(values), [None, self.pa.py_buffer(values)])
+
+    def write(self, store: ChunkStore) -> None:
+        if not len(store):
+            return
+        pa = self.pa
+        n = len(store)
+        text = pa.LargeStringArray.from_buffers(n, pa.py_buffer(store.offsets), pa.py_buffer(bytes(store.data)))
+        doc_name = pa.array(store.doc_names, pa.string()).take(self._ints(pa.int32(), store.doc_ids))
+        batch = pa.record_batch([
+            text,
+            self._ints(pa.int64(), store.chunk_ids),
+            doc_name,
+            self._ints(pa.int32(), store.page_starts),
+            self._ints(pa.int32(), store.page_ends),
+            self._ints(pa.int32(), store.n_tokens),
+        ] + [self._ints(pa.float64(), col) for col in store.quality], schema=self.schema)
+        self._writer.write_batch(batch)
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def compression_available(compression: str) -> bool:
+    return compression != "zstd" or _zstandard() is not None
+
+
+def shard_stem(jsonl_path: str) -> str:
+    return jsonl_path[:-len(".jsonl")] if jsonl_path.endswith(".jsonl") else jsonl_path
+
+
+def open_shard(path: str) -> io.TextIOBase:
+    """Open a (possibly compressed) JSONL shard for reading as text."""
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith(".zst"):
+        raw = open(path, 'rb')
+        return io.TextIOWrapper(_zstandard().ZstdDecompressor().stream_reader(raw, closefd=True), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+class _HashingFile:
+    """Write-only file wrapper that checksums and counts the bytes that reach disk."""
+
+    def __init__(self, path: str):
+        self._f = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.nbytes = 0
+
+    def write(self, data: bytes) -> int:
+        self._f.write(data)
+        self.sha256.update(data)
+        self.nbytes += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class ShardedJsonlWriter:
+    """
+    dataset.jsonl split into <stem>-00000.jsonl[.gz|.zst] shards, rolled over at document
+    boundaries once a shard reaches shard_records records or shard_bytes (uncompressed)
+    bytes. Compression and disk writes run in a background thread fed by a bounded queue.
+    Shards are renamed to <stem>-00000-of-00042... by finish(), which returns their
+    manifest entries (records, tokens, chunk id range, bytes, sha256).
+    """
+
+    def __init__(self, jsonl_path: str, compression: str = "none", shard_records: int = 0, shard_bytes: int = 0,
+                 shards: Optional[List[dict]] = None):
+        self.stem = shard_stem(jsonl_path)
+        self.dir = os.path.dirname(self.stem) or "."
+        self.compression = compression
+        self.ext = ".jsonl" + COMPRESSIONS[compression]
+        self.shard_records = shard_records
+        self.shard_bytes = shard_bytes
+        self.shards: List[dict] = list(shards or [])
+        self._queue: "queue.Queue" = queue.Queue(maxsize=256)
+        self._results: "queue.Queue" = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="shard-writer", daemon=True)
+        self._thread.start()
+        self._open_shard()
+
+    def shard_path(self, i: int, total: Optional[int] = None) -> str:
+        suffix = f"-{i:05d}" + (f"-of-{total:05d}" if total is not None else "")
+        return self.stem + suffix + self.ext
+
+    def _open_shard(self) -> None:
+        self.records = self.tokens = self.bytes = 0
+        self.first_id = self.last_id = None
+        self._put(("open", self.shard_path(len(self.shards))))
+
+    def _put(self, item: tuple) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(item)
+
+    def _run(self) -> None:
+        raw = out = None
+        while True:
+            op, arg = self._queue.get()
+            try:
+                if self._error is not None and op not in ("close", "stop"):
+                    continue
+                if op == "open":
+                    raw = _HashingFile(arg)
+                    if self.compression == "gzip":
+                        out = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+                    elif self.compression == "zstd":
+                        out = _zstandard().ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+                    else:
+                        out = raw
+                elif op == "data":
+                    out.write(arg)
+                elif op == "close":
+                    if out is not raw:
+                        out.close()
+                    raw.close()
+                    self._results.put((raw.sha256.hexdigest(), raw.nbytes))
+                elif op == "stop":
+                    return
+            except BaseException as e:  # surfaced to the producer on its next call
+                self._error = e
+                if op == "close":
+                    self._results.put(None)
+
+    def write(self, line: str, ch: Chunk) -> None:
+        data = (line + "\n").encode("utf-8")
+        self._put(("data", data))
+        self.records += 1
+        self.tokens += ch.n_tokens
+        self.bytes += len(data)
+        if self.first_id is None:
+            self.first_id = ch.index
+        self.last_id = ch.index
+
+    def full(self) -> bool:
+        return ((self.shard_records > 0 and self.records >= self.shard_records)
+                or (self.shard_bytes > 0 and self.bytes >= self.shard_bytes))
+
+    def _close_shard(self) -> dict:
+        self._put(("close", None))
+        result = self._results.get()
+        if self._error is not None:
+            raise self._error
+        sha256, nbytes = result
+        info = {
+            "path": os.path.basename(self.shard_path(len(self.shards))),
+            "records": self.records,
+            "tokens": self.tokens,
+            "first_chunk_id": self.first_id,
+            "last_chunk_id": self.last_id,
+            "uncompressed_bytes": self.bytes,
+            "bytes": nbytes,
+            "sha256": sha256,
+        }
+        self.shards.append(info)
+        return info
+
+    def rollover(self) -> dict:
+        """Close the current shard and start the next; returns the closed shard's manifest entry."""
+        info = self._close_shard()
+        self._open_shard()
+        return info
+
+    def finish(self, finished: bool = True) -> List[dict]:
+        info = self._close_shard()
+        # the open shard of an interrupted run is redone on resume; an empty trailing
+        # shard is dropped unless it is the only one
+        if not finished or (not info["records"] and len(self.shards) > 1):
+            self.shards.pop()
+            os.remove(os.path.join(self.dir, info["path"]))
+        self._put(("stop", None))
+        self._thread.join()
+        if finished:
+            total = len(self.shards)
+            for i, info in enumerate(self.shards):
+                final = self.shard_path(i, total)
+                os.replace(os.path.join(self.dir, info["path"]), final)
+                info["path"] = os.path.basename(final)
+        return self.shards
+
+    def iter_lines(self) -> Iterator[str]:
+        """Lines of the closed shards, in order."""
+        for info in self.shards:
+            with open_shard(os.path.join(self.dir, info["path"])) as f:
+                yield from f
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DatasetWriter:
+    """
+    Appends records to dataset.jsonl / audit.csv as documents complete. After each
+    document a line is appended to <output_jsonl>.progress with the byte offsets of both
+    outputs and the input file's size, mtime and sha256, so an interrupted run can be
+    resumed from the last completed document (see pending() for which inputs are skipped).
+    A finished run appends a final entry and keeps the file, so --resume / --watch can add
+    to a finished build; resuming over existing outputs without it raises instead of
+    starting over.
+    With arrow_path, kept chunks are also buffered in a ChunkStore and flushed to an
+    ArrowDatasetWriter every arrow_batch_rows records; on resume that file is rebuilt from
+    the records already in the JSONL/CSV outputs.
+
+    With compression or a shard limit the JSONL goes to a ShardedJsonlWriter instead, and
+    a <stem>.manifest.json is written on success. Resuming a sharded run restarts from
+    the last shard boundary: documents in the unfinished shard are processed again.
+    """
+
+    def __init__(self, jsonl_path: str, csv_path: str, resume: bool = False, arrow_path: Optional[str] = None,
+                 arrow_batch_rows: int = 65536, compression: str = "none", shard_records: int = 0,
+                 shard_bytes: int = 0):
+        self.jsonl_path = jsonl_path
+        self.csv_path = csv_path
+        self.progress_path = jsonl_path + ".progress"
+        self.sharded = compression != "none" or shard_records > 0 or shard_bytes > 0
+        self.manifest_path = shard_stem(jsonl_path) + ".manifest.json" if self.sharded else None
+        self.completed: Dict[str, dict] = {}  # input path -> fingerprint when it was written
+        self.next_index = 0
+        self.num_chunks = 0
+        self.total_tokens = 0
+
+        state = self._load_progress() if resume else None
+        if state is not None and state.get("sharded", False) != self.sharded:
+            raise RuntimeError(f"{self.progress_path} was written with different output sharding; "
+                               "run without --resume to start over")
+        if resume and state is None and not os.path.exists(self.progress_path):
+            existing = self._existing_outputs()
+            if existing:
+                raise RuntimeError(f"Cannot resume: {', '.join(existing)} exist but {self.progress_path} does not; "
+                                   "remove them or run without --resume to start over")
+        if state is None:
+            if self.sharded:
+                self.jsonl = ShardedJsonlWriter(jsonl_path, compression, shard_records, shard_bytes)
+            else:
+                self.jsonl = open(jsonl_path, 'w', encoding='utf-8')
+            self.csv = open(csv_path, 'w', encoding='utf-8')
+            self.csv.write(AUDIT_HEADER + "\n")
+            self.progress = open(self.progress_path, 'w', encoding='utf-8')
+        else:
+            # drop anything written after the last completed document
+            if self.sharded:
+                self.jsonl = ShardedJsonlWriter(jsonl_path, compression, shard_records, shard_bytes, state["shards"])
+            else:
+                with open(jsonl_path, 'r+b') as f:
+                    f.truncate(state["jsonl_bytes"])
+            with open(csv_path, 'r+b') as f:
+                f.truncate(state["csv_bytes"])
+            self.next_index = state["next_index"]
+            self.num_chunks = state["num_chunks"]
+            self.total_tokens = state["total_tokens"]
+            if not self.sharded:
+                self.jsonl = open(jsonl_path, 'a', encoding='utf-8')
+            self.csv = open(csv_path, 'a', encoding='utf-8')
+            self.progress = open(self.progress_path, 'a', encoding='utf-8')
+
+        self.arrow = ArrowDatasetWriter(arrow_path) if arrow_path else None
+        self.arrow_batch_rows = arrow_batch_rows
+        self._batch = ChunkStore()
+        if self.arrow is not None and state is not None:
+            for ch in self.iter_written_chunks():
+                self._add_to_batch(ch)
+
+    def _existing_outputs(self) -> List[str]:
+        stem = shard_stem(self.jsonl_path)
+        paths = [self.jsonl_path, self.csv_path, stem + ".manifest.json"]
+        paths += sorted(glob.glob(glob.escape(stem) + "-[0-9]*.jsonl*"))
+        return [p for p in paths if os.path.exists(p)]
+
+    def _load_progress(self) -> Optional[dict]:
+        jsonl_written = self.sharded or os.path.exists(self.jsonl_path)
+        if not (os.path.exists(self.progress_path) and jsonl_written and os.path.exists(self.csv_path)):
+            return None
+        state = None
+        files: Dict[str, dict] = {}
+        shards: List[dict] = []
+        with open(self.progress_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # torn final line from a crash
+                if entry.get("finished"):
+                    # written by close(); the shards listed here have their final -of- names
+                    state = entry
+                    self.completed.update(files)
+                    files = {}
+                    shards = list(entry.get("shards", []))
+                    continue
+                files[entry["file"]] = entry.get("input", {})
+                if not entry.get("sharded", False):
+                    state = entry
+                    self.completed.update(files)
+                    files = {}
+                    continue
+                if entry.get("closed_shard"):
+                    shards.append(entry["closed_shard"])
+                # only documents that ended in a closed shard count as done
+                if entry["open_records"] == 0:
+                    state = dict(entry, shards=list(shards))
+                    self.completed.update(files)
+                    files = {}
+        return state
+
+    def pending(self, file_paths: List[str]) -> List[str]:
+        """
+        Inputs still to process. A completed path is skipped while its size and mtime are
+        unchanged, or its sha256 still matches; a changed file is processed again. A file
+        whose contents were completed under a path that is no longer an input (renamed or
+        moved) is skipped too. Progress from older versions only records paths.
+        """
+        inputs = set(file_paths)
+        moved = {done["sha256"]: path for path, done in self.completed.items()
+                 if "sha256" in done and path not in inputs}
+        todo = []
+        for fp in file_paths:
+            done = self.completed.get(fp)
+            if done is not None and "sha256" not in done:
+                continue
+            if done is not None:
+                st = os.stat(fp)
+                if (st.st_size, st.st_mtime_ns) == (done["size"], done["mtime_ns"]):
+                    continue
+            if done is not None or moved:
+                digest = file_sha256(fp)
+                if done is not None and digest == done["sha256"]:
+                    continue
+                if done is None and digest in moved:
+                    print(f"Skipping {fp}: already processed as {moved.pop(digest)}")
+                    continue
+                if done is not None:
+                    print(f"{fp} changed since it was processed; processing it again")
+            todo.append(fp)
+        return todo
+
+    def _iter_written_lines(self) -> Iterator[str]:
+        if self.sharded:
+            yield from self.jsonl.iter_lines()
+            return
+        self.jsonl.flush()
+        with open(self.jsonl_path, 'r', encoding='utf-8') as f:
+            yield from f
+
+    def iter_written_texts(self) -> Iterator[str]:
+        """Texts already in dataset.jsonl, used to warm the dedupe index on resume."""
+        for line in self._iter_written_lines():
+            yield json.loads(line)["text"]
+
+    def iter_written_chunks(self) -> Iterator[Chunk]:
+        """Records already in dataset.jsonl + audit.csv, read back in lock-step."""
+        self.csv.flush()
+        with open(self.csv_path, 'r', encoding='utf-8') as fc:
+            next(fc, None)  # header
+            for line, row in zip(self._iter_written_lines(), fc):
+                chunk_id, doc_name, page_start, page_end, n_tokens, quality = parse_audit_line(row)
+                yield Chunk(doc_name=doc_name, index=chunk_id, text=json.loads(line)["text"],
+                            pages=(page_start, page_end), n_tokens=n_tokens, quality=quality)
+
+    def _add_to_batch(self, ch: Chunk) -> None:
+        self._batch.append(ch)
+        if len(self._batch) >= self.arrow_batch_rows:
+            self.arrow.write(self._batch)
+            self._batch.clear()
+
+    def write_document(self, fp: str, chunks: List[Chunk], next_index: int, fingerprint: dict,
+                       close_shard: bool = False) -> None:
+        """
+        Append one document's kept chunks, recording fingerprint (PdfSource.fingerprint() as the
+        worker read it); close_shard closes a non-empty open shard after it.
+        """
+        for ch in chunks:
+            if self.sharded:
+                self.jsonl.write(jsonl_line(ch), ch)
+            else:
+                self.jsonl.write(jsonl_line(ch) + "\n")
+            self.csv.write(audit_line(ch) + "\n")
+            self.total_tokens += ch.n_tokens
+            if self.arrow is not None:
+                self._add_to_batch(ch)
+        self.num_chunks += len(chunks)
+        self.next_index = next_index
+        self.csv.flush()
+        entry = {
+            "file": fp,
+            "input": fingerprint,
+            "next_index": next_index,
+            "csv_bytes": self.csv.tell(),
+            "num_chunks": self.num_chunks,
+            "total_tokens": self.total_tokens,
+        }
+        if self.sharded:
+            entry["sharded"] = True
+            if self.jsonl.full() or (close_shard and self.jsonl.records):
+                entry["closed_shard"] = self.jsonl.rollover()
+            entry["open_records"] = self.jsonl.records
+        else:
+            self.jsonl.flush()
+            entry["jsonl_bytes"] = self.jsonl.tell()
+        self.progress.write(json.dumps(entry) + "\n")
+        self.progress.flush()
+        self.completed[fp] = entry["input"]
+
+    def at_checkpoint(self) -> bool:
+        """True when a resume would restart exactly here (sharded runs resume at shard boundaries)."""
+        return not self.sharded or self.jsonl.records == 0
+
+    def sync(self) -> None:
+        """fsync the audit CSV, unsharded JSONL and progress file so a checkpoint survives a power loss."""
+        files = [self.csv, self.progress] + ([] if self.sharded else [self.jsonl])
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_manifest(self) -> None:
+        """Write <stem>.manifest.json for the closed shards (a sharded run does this when it finishes)."""
+        write_text_atomic(self.manifest_path, json.dumps({
+            "format": "jsonl",
+            "compression": self.jsonl.compression,
+            "num_shards": len(self.jsonl.shards),
+            "num_records": sum(info["records"] for info in self.jsonl.shards),
+            "total_tokens": sum(info["tokens"] for info in self.jsonl.shards),
+            "audit": os.path.basename(self.csv_path),
+            "shards": self.jsonl.shards,
+        }, indent=2))
+
+    def close(self, finished: bool = True) -> None:
+        entry = {
+            "finished": True,
+            "next_index": self.next_index,
+            "num_chunks": self.num_chunks,
+            "total_tokens": self.total_tokens,
+        }
+        if self.sharded:
+            self.jsonl.finish(finished)
+            if finished:
+                self.write_manifest()
+                entry.update(sharded=True, shards=self.jsonl.shards, open_records=0)
+        else:
+            entry["jsonl_bytes"] = self.jsonl.tell()
+            self.jsonl.close()
+        entry["csv_bytes"] = self.csv.tell()
+        self.csv.close()
+        if finished:
+            self.progress.write(json.dumps(entry) + "\n")
+        self.progress.close()
+        if self.arrow is not None:
+            # an unfinished run leaves a valid but partial file; --resume rebuilds it
+            self.arrow.write(self._batch)
+            self._batch.clear()
+            self.arrow.close()
+
+
+class DedupeCheckpoint:
+    """
+    Periodic pickle of the dedupe indexes next to the outputs (<output_jsonl>.dedupe.pkl),
+    tagged with the number of records they cover. On resume the snapshot replaces the
+    warm-up over those records, so only records written after it are re-hashed. Snapshots
+    from other dedupe settings, or covering records a resume dropped, are ignored. The
+    file is trusted like the rest of the outputs; do not resume from untrusted ones.
+    """
+
+    def __init__(self, jsonl_path: str, config: dict, interval: float = 300.0):
+        self.path = jsonl_path + ".dedupe.pkl"
+        self.config = config
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def due(self) -> bool:
+        return self.interval > 0 and time.monotonic() - self.last >= self.interval
+
+    def save(self, num_records: int, dedupe_index, semantic_index) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump({"config": self.config, "num_records": num_records, "dedupe": dedupe_index,
+                         "semantic": semantic_index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.last = time.monotonic()
+
+    def load(self, max_records: int, semantic_index):
+        """Returns (records covered, dedupe index, semantic index) or None if unusable."""
+        try:
+            with open(self.path, 'rb') as f:
+                snap = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if snap.get("config") != self.config or snap["num_records"] > max_records:
+            return None
+        if snap["semantic"] is not None:
+            snap["semantic"].embedder = semantic_index.embedder
+        return snap["num_records"], snap["dedupe"], snap["semantic"]
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def dataset_stats(num_documents: int, num_chunks: int, total_tokens: int) -> Dict[str, int]:
+    return {
+        "num_documents": num_documents,
+        "num_chunks": num_chunks,
+        "total_approx_tokens": total_tokens,
+        "avg_tokens_per_chunk": (total_tokens // max(1, num_chunks)) if num_chunks else 0,
+    }
+
+
+class IncrementalBuild:
+    """
+    Dataset outputs (DatasetWriter) plus dedupe indexes kept warm across batches of PDFs.
+    write_dataset_from_pdfs adds a single batch; watch_pdfs keeps adding batches as files
+    arrive. Every checkpoint_seconds (0 = never) the outputs are fsynced and the dedupe
+    indexes snapshotted with DedupeCheckpoint, so resuming does not re-hash everything.
+    With pool, documents go to that long-lived ProcessPoolExecutor instead of a new pool
+    per batch.
+    """
+
+    def __init__(self, jsonl_path: str, csv_path: str, target_tokens: int, overlap_tokens: int, rm_headers: bool,
+                 do_dedupe: bool, workers: int = 1, dedupe_method: str = "minhash",
+                 cache: Optional[BuildCache] = None, resume: bool = False, chunker: str = "paragraph",
+                 metrics: Optional[Metrics] = None, page_batch: int = 256, arrow_path: Optional[str] = None,
+                 compression: str = "none", shard_records: int = 0, shard_bytes: int = 0,
+                 semantic: Optional[str] = None, semantic_threshold: float = 0.92,
+                 quality_filter: Optional[QualityFilter] = None, checkpoint_seconds: float = 300.0,
+                 pool: Optional[ProcessPoolExecutor] = None):
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+        self.rm_headers = rm_headers
+        self.workers = workers
+        self.cache = cache
+        self.chunker = chunker
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.page_batch = page_batch
+        self.quality_filter = quality_filter
+        self.pool = pool
+        self.documents_added = 0
+        self.in_progress: Optional[str] = None  # input add() is processing or writing, None between documents
+        self.writer = DatasetWriter(jsonl_path, csv_path, resume=resume, arrow_path=arrow_path,
+                                    compression=compression, shard_records=shard_records, shard_bytes=shard_bytes)
+        self.dedupe_index = make_dedupe_index(dedupe_method) if do_dedupe else None
+        self.semantic_index = make_semantic_index(semantic, semantic_threshold)
+        self._checkpoint = None
+        if self.dedupe_index is not None or self.semantic_index is not None:
+            self._checkpoint = DedupeCheckpoint(jsonl_path, {
+                "dedupe": type(self.dedupe_index).__name__ if self.dedupe_index is not None else None,
+                "semantic": semantic, "semantic_threshold": semantic_threshold,
+            }, checkpoint_seconds)
+            if self.writer.completed:
+                with self.metrics.stage("resume_dedupe_warmup"):
+                    self._warm_up()
+            else:
+                self._checkpoint.remove()  # left over from an earlier run
+
+    def _warm_up(self) -> None:
+        skip = 0
+        snap = self._checkpoint.load(self.writer.num_chunks, self.semantic_index)
+        if snap is not None:
+            skip, self.dedupe_index, self.semantic_index = snap
+            print(f"Restored dedupe indexes covering {skip} record(s)")
+        batch: List[str] = []
+        for text in islice(self.writer.iter_written_texts(), skip, None):
+            if self.dedupe_index is not None:
+                self.dedupe_index.add_if_new(word_set(text))
+            if self.semantic_index is not None:
+                batch.append(text)
+                if len(batch) == 256:
+                    self.semantic_index.add_batch(batch)
+                    batch = []
+        if self.semantic_index is not None:
+            self.semantic_index.add_batch(batch)
+
+    def pending(self, file_paths: List[str]) -> List[str]:
+        return self.writer.pending(file_paths)
+
+    def add(self, file_paths: List[str], close_shard: bool = False, stop: Optional[threading.Event] = None) -> int:
+        """
+        Process file_paths in order and append their records; returns the number of documents
+        written. close_shard closes the open JSONL shard after the last one so its records are
+        readable. Once stop is set, returns after the document in progress.
+        """
+        done = 0
+        self.in_progress = file_paths[0] if file_paths else None
+        for fp, kept, next_index, fingerprint in iter_dataset(file_paths, self.target_tokens, self.overlap_tokens, self.rm_headers,
+                                                              self.dedupe_index, self.workers, self.cache, self.writer.next_index,
+                                                              self.chunker, self.metrics, self.page_batch, self.semantic_index,
+                                                              self.quality_filter, self.pool):
+            stopping = stop is not None and stop.is_set()
+            with self.metrics.stage("write"):
+                self.writer.write_document(fp, kept, next_index, fingerprint,
+                                           close_shard=close_shard and (stopping or fp == file_paths[-1]))
+            done += 1
+            self.documents_added += 1
+            self.in_progress = None
+            self.checkpoint()
+            if stopping:
+                break
+            self.in_progress = file_paths[done] if done < len(file_paths) else None
+        return done
+
+    def checkpoint(self, force: bool = False) -> None:
+        """fsync the outputs and snapshot the dedupe indexes if due (or forced) and at a resume point."""
+        cp = self._checkpoint
+        if cp is None or cp.interval <= 0 or not (force or cp.due()) or not self.writer.at_checkpoint():
+            return
+        with self.metrics.stage("checkpoint"):
+            self.writer.sync()
+            cp.save(self.writer.num_chunks, self.dedupe_index, self.semantic_index)
+        self.metrics.count("checkpoints")
+
+    def close(self, finished: bool = True) -> None:
+        self.writer.close(finished)
+        if finished and self._checkpoint is not None:
+            self._checkpoint.remove()
+        if self.cache is not None:
+            self.cache.evict()
+
+
+def write_dataset_from_pdfs(file_paths: List[str], jsonl_path: str, csv_path: str, target_tokens: int, overlap_tokens: int,
+                            rm_headers: bool, do_dedupe: bool, workers: int = 1, dedupe_method: str = "minhash",
+                            cache: Optional[BuildCache] = None, resume: bool = False,
+                            chunker: str = "paragraph", metrics: Optional[Metrics] = None,
+                            page_batch: int = 256, arrow_path: Optional[str] = None, compression: str = "none",
+                            shard_records: int = 0, shard_bytes: int = 0, semantic: Optional[str] = None,
+                            semantic_threshold: float = 0.92, quality_filter: Optional[QualityFilter] = None,
+                            checkpoint_seconds: float = 300.0) -> Dict[str, int]:
+    """Streaming build: memory is bounded by the documents in flight plus the dedupe indexes."""
+    build = IncrementalBuild(jsonl_path, csv_path, target_tokens, overlap_tokens, rm_headers, do_dedupe, workers,
+                             dedupe_method, cache, resume, chunker, metrics, page_batch, arrow_path, compression,
+                             shard_records, shard_bytes, semantic, semantic_threshold, quality_filter,
+                             checkpoint_seconds)
+    todo = build.pending(file_paths)
+    if build.writer.completed:
+        print(f"Resuming: {len(file_paths) - len(todo)} document(s) already done")
+    finished = False
+    try:
+        build.add(todo)
+        finished = True
+    finally:
+        build.close(finished)
+    return dataset_stats(len(file_paths), build.writer.num_chunks, build.writer.total_tokens)
+
+
+def _start_observer(input_dir: str, wake: threading.Event):
+    """watchdog observer that sets wake on any change in input_dir, or None without watchdog."""
+    wd = _watchdog()
+    if wd is None:
+        return None
+
+    class Handler(wd.events.FileSystemEventHandler):
+        def on_any_event(self, event):
+            wake.set()
+
+    observer = wd.observers.Observer()
+    observer.schedule(Handler(), input_dir, recursive=False)
+    observer.start()
+    return observer
+
+
+def watch_pdfs(input_dir: str, build: IncrementalBuild, poll_seconds: float = 5.0, settle_seconds: float = 2.0,
+               stop: Optional[threading.Event] = None,
+               on_batch: Optional[Callable[[List[str], Dict[str, int]], None]] = None) -> None:
+    """
+    Daemon loop: add new or changed *.pdf files in input_dir to build until stop is set.
+    The directory is rescanned (one scandir, no reads) every poll_seconds, or as soon as
+    watchdog (inotify/FSEvents/...) reports a change when it is installed. A file is picked
+    up once its mtime is settle_seconds old, so half-copied files are left for later.
+    Each batch closes the open shard and rewrites the manifest, so consumers see new
+    records right away (shards keep their <stem>-00000.jsonl names, as the total is never
+    known); on_batch(processed paths, stats) runs after each batch. When
+    stopped the dedupe indexes are checkpointed and the outputs left resumable.
+    """
+    stop = stop if stop is not None else threading.Event()
+    wake = threading.Event()
+    observer = _start_observer(input_dir, wake)
+    seen: Dict[str, Tuple[int, int]] = {}  # path -> (size, mtime_ns) already handed to the build
+    try:
+        while not stop.is_set():
+            now = time.time_ns()
+            ready: List[str] = []
+            settling = False
+            with os.scandir(input_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".pdf") or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    if seen.get(entry.path) == (st.st_size, st.st_mtime_ns):
+                        continue
+                    if now - st.st_mtime_ns < settle_seconds * 1e9:
+                        settling = True
+                        continue
+                    ready.append(entry.path)
+                    seen[entry.path] = (st.st_size, st.st_mtime_ns)
+            # sorted so chunk ids within a batch do not depend on directory order
+            todo = build.pending(sorted(ready))
+            if todo:
+                added = build.documents_added
+                try:
+                    done = build.add(todo, close_shard=True, stop=stop)
+                except Exception as exc:
+                    # documents before the failing one are written; the failing file stays in
+                    # seen (retried once it changes), the rest are picked up on the next scan
+                    done = build.documents_added - added
+                    failed = build.in_progress
+                    if failed is not None:
+                        print(f"Failed to process {failed}: {exc!r}; skipping it until it changes")
+                    else:  # between documents, e.g. a checkpoint
+                        print(f"Failed after adding {done} PDF(s): {exc!r}")
+                    for fp in todo[done + 1:] if failed is not None else todo[done:]:
+                        seen.pop(fp, None)
+                if build.writer.sharded:
+                    build.writer.write_manifest()
+                if on_batch is not None and done:
+                    on_batch(todo[:done], dataset_stats(len(build.writer.completed), build.writer.num_chunks,
+                                                        build.writer.total_tokens))
+                continue
+            deadline = time.monotonic() + (min(poll_seconds, settle_seconds) if settling else poll_seconds)
+            while not (stop.is_set() or wake.is_set()) and time.monotonic() < deadline:
+                wake.wait(min(0.5, max(0.0, deadline - time.monotonic())))
+            wake.clear()
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+    build.checkpoint(force=True)
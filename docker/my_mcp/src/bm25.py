@@ -0,0 +1,657 @@
+# bm25.py
+"""Persistent BM25 index over a cpt_dataset_builder output (dataset.jsonl or its shards + audit.csv).
+
+The index is a directory of immutable segments plus meta.json. Each segment holds numpy
+arrays that are memory-mapped at query time: sorted terms, posting offsets, doc ids and
+term frequencies, chunk lengths, and per-chunk metadata (chunk id, doc name, page span,
+where the record sits in its source file). Chunk text is never loaded; it is read back from the
+source file only for the hits being returned.
+
+update_index() is incremental: it resumes from the cursor in meta.json and indexes only
+records appended since (new lines of an unsharded dataset.jsonl, new shards listed in the
+manifest), writing a new segment every segment_docs records and merging the smallest
+adjacent segments once there are more than max_segments. If the dataset was rewritten
+(a fresh build, a changed shard) the index is rebuilt from scratch.
+
+    python bm25.py build /data/cpt/dataset.jsonl
+    python bm25.py search /data/cpt/dataset.jsonl "hydraulic pump pressure" -k 5
+"""
+from __future__ import annotations
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so _locked() does not serialize writers there
+    fcntl = None
+
+INDEX_VERSION = 1
+TOKEN_RE = re.compile(r"\w+")
+MAX_TERM_BYTES = 32
+TERM_DTYPE = np.dtype(f"S{MAX_TERM_BYTES}")
+DOC_DTYPE = np.dtype([
+    ("chunk_id", "<i8"),
+    ("name", "<u4"),  # index into the segment's names.json
+    ("page_start", "<i4"),
+    ("page_end", "<i4"),
+    ("source", "<u4"),  # index into meta["sources"]
+    ("offset", "<i8"),  # byte offset of the JSONL line in its source; -1 when compressed
+    ("length", "<u4"),
+])
+SEGMENT_DOCS = 100_000
+MAX_SEGMENTS = 16
+MERGE_BLOCK = 1 << 23  # postings copied per step while merging
+ANCHOR_BYTES = 4096
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens; single characters and terms longer than MAX_TERM_BYTES are dropped."""
+    return [t for t in TOKEN_RE.findall(text.lower()) if len(t) > 1 and len(t.encode("utf-8")) <= MAX_TERM_BYTES]
+
+
+def default_index_dir(dataset: str) -> str:
+    stem = dataset[:-len(".jsonl")] if dataset.endswith(".jsonl") else dataset
+    return stem + ".bm25"
+
+
+# ---------------------------------------------------------------------------
+# Reading the builder's output
+# ---------------------------------------------------------------------------
+
+def _open_source(path: str) -> io.BufferedIOBase:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        import zstandard  # only needed for --compress zstd datasets
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
+def _anchor(path: str, offset: int) -> Optional[str]:
+    """Hash of the bytes just before offset, to notice a file rewritten under the index."""
+    try:
+        with open(path, "rb") as f:
+            start = max(0, offset - ANCHOR_BYTES)
+            f.seek(start)
+            data = f.read(offset - start)
+    except OSError:
+        return None
+    return hashlib.sha256(data).hexdigest() if len(data) == offset - start else None
+
+
+def _last_progress(jsonl_path: str) -> Optional[dict]:
+    """Last complete entry of an unsharded run's .progress file (a finished run's ends at the final offsets)."""
+    entry = None
+    try:
+        with open(jsonl_path + ".progress", "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # torn final line
+    except OSError:
+        return None
+    return entry if entry is not None and "jsonl_bytes" in entry else None
+
+
+def dataset_layout(dataset: str, audit: Optional[str] = None) -> dict:
+    """
+    What the builder has committed so far. Sharded output is read from <stem>.manifest.json
+    (written when a run finishes and after every --watch batch); an unsharded dataset.jsonl
+    is read up to the offsets of the last completed document in its .progress file, or to
+    the end when there is none.
+    """
+    root = os.path.dirname(os.path.abspath(dataset))
+    stem = dataset[:-len(".jsonl")] if dataset.endswith(".jsonl") else dataset
+    manifest_path = stem + ".manifest.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        audit = audit or os.path.join(root, manifest.get("audit", "audit.csv"))
+        return {
+            "root": root,
+            "sharded": True,
+            "sources": [{"path": s["path"], "sha256": s["sha256"], "bytes": s["uncompressed_bytes"]}
+                        for s in manifest["shards"]],
+            "audit": os.path.abspath(audit),
+            "jsonl_limit": None,
+            "audit_limit": os.path.getsize(audit),
+        }
+    audit = audit or os.path.join(root, "audit.csv")
+    if not os.path.exists(dataset):
+        raise FileNotFoundError(f"No dataset at {dataset} (and no {manifest_path})")
+    progress = _last_progress(dataset)
+    return {
+        "root": root,
+        "sharded": False,
+        "sources": [{"path": os.path.basename(dataset), "sha256": None, "bytes": None}],
+        "audit": os.path.abspath(audit),
+        "jsonl_limit": progress["jsonl_bytes"] if progress else os.path.getsize(dataset),
+        "audit_limit": progress["csv_bytes"] if progress else os.path.getsize(audit),
+    }
+
+
+def _audit_splitter(audit: str):
+    """Parser for audit.csv rows; the column count comes from the header so older builds parse too."""
+    with open(audit, "rb") as f:
+        header = f.readline()
+    trailing = header.count(b",") - 1  # columns after doc_name
+
+    def parse(row: bytes) -> Tuple[int, str, int, int]:
+        chunk_id, rest = row.decode("utf-8").rstrip("\n").split(",", 1)
+        doc_name, page_start, page_end = rest.rsplit(",", trailing)[:3]
+        return int(chunk_id), doc_name, int(page_start), int(page_end)
+    return parse, len(header)
+
+
+def _iter_records(meta: dict, layout: dict) -> Iterator[tuple]:
+    """
+    Records after meta["cursor"], paired in order with their audit rows:
+    (text, chunk_id, doc_name, page_start, page_end, source, offset, length, cursor after it).
+    """
+    cursor = dict(meta["cursor"])
+    parse, header_len = _audit_splitter(layout["audit"])
+    with open(layout["audit"], "rb") as fa:
+        fa.seek(max(cursor["audit_offset"], header_len))
+        audit_pos = fa.tell()
+        for source in range(cursor["source"], len(layout["sources"])):
+            shard_bytes = layout["sources"][source]["bytes"]
+            path = os.path.join(layout["root"], layout["sources"][source]["path"])
+            compressed = path.endswith((".gz", ".zst"))
+            start = cursor["offset"] if source == cursor["source"] else 0
+            limit = layout["jsonl_limit"]
+            with _open_source(path) as fj:
+                pos = 0
+                if compressed:
+                    while pos < start:  # no random access into a compressed shard
+                        pos += len(fj.readline())
+                else:
+                    fj.seek(start)
+                    pos = start
+                while limit is None or pos < limit:
+                    line = fj.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    if audit_pos >= layout["audit_limit"]:
+                        return
+                    row = fa.readline()
+                    if not row.endswith(b"\n"):
+                        return
+                    audit_pos += len(row)
+                    chunk_id, doc_name, page_start, page_end = parse(row)
+                    offset = -1 if compressed else pos
+                    pos += len(line)
+                    # past a shard's last record the cursor moves to the next shard, so a
+                    # later update does not reopen (and for .gz/.zst, re-read) this one
+                    after = ({"source": source + 1, "offset": 0, "audit_offset": audit_pos} if pos == shard_bytes
+                             else {"source": source, "offset": pos, "audit_offset": audit_pos})
+                    yield (json.loads(line)["text"], chunk_id, doc_name, page_start, page_end, source, offset,
+                           len(line), after)
+            if not layout["sharded"]:
+                return
+
+
+# ---------------------------------------------------------------------------
+# Segments
+# ---------------------------------------------------------------------------
+
+class SegmentBuilder:
+    """Accumulates records in compact arrays and writes them out as one segment."""
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.term_ids = array("I")
+        self.doc_ids = array("I")
+        self.tfs = array("H")
+        self.doc_len = array("I")
+        self.docs: List[tuple] = []
+        self.names: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, text: str, chunk_id: int, doc_name: str, page_start: int, page_end: int, source: int,
+            offset: int, length: int) -> None:
+        counts = Counter(tokenize(text))
+        d = len(self.docs)
+        for term, tf in counts.items():
+            self.term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+            self.doc_ids.append(d)
+            self.tfs.append(min(tf, 0xFFFF))
+        self.doc_len.append(sum(counts.values()))
+        name = self.names.setdefault(doc_name, len(self.names))
+        self.docs.append((chunk_id, name, page_start, page_end, source, offset, length))
+
+    def write(self, path: str) -> dict:
+        terms = sorted(self.vocab)  # code point order == UTF-8 byte order, as numpy compares them
+        rank = np.empty(len(terms), np.uint32)
+        rank[[self.vocab[t] for t in terms]] = np.arange(len(terms), dtype=np.uint32)
+        tids = rank[np.frombuffer(self.term_ids, np.uint32)]
+        order = np.argsort(tids, kind="stable")  # stable: doc ids stay ascending within a term
+        starts = np.zeros(len(terms) + 1, np.int64)
+        np.cumsum(np.bincount(tids, minlength=len(terms)), out=starts[1:])
+        doc_len = np.frombuffer(self.doc_len, np.uint32)
+        _write_segment(path, {
+            "terms": np.array([t.encode("utf-8") for t in terms], TERM_DTYPE),
+            "starts": starts,
+            "doc_ids": np.frombuffer(self.doc_ids, np.uint32)[order],
+            "tfs": np.frombuffer(self.tfs, np.uint16)[order],
+            "doc_len": doc_len,
+            "docs": np.array(self.docs, DOC_DTYPE),
+        }, list(self.names))
+        return {"docs": len(doc_len), "total_len": int(doc_len.sum())}
+
+
+def _write_segment(path: str, arrays: Dict[str, np.ndarray], names: List[str]) -> None:
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), values)
+    with open(os.path.join(tmp, "names.json"), "w", encoding="utf-8") as f:
+        json.dump(names, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class Segment:
+    """One immutable segment, memory-mapped. Doc ids are local; base is the global id of doc 0."""
+
+    def __init__(self, path: str, base: int = 0):
+        self.path = path
+        self.base = base
+        self.terms = self._map("terms")
+        self.starts = self._map("starts")
+        self.doc_ids = self._map("doc_ids")
+        self.tfs = self._map("tfs")
+        self.doc_len = self._map("doc_len")
+        self.docs = self._map("docs")
+        with open(os.path.join(path, "names.json"), "r", encoding="utf-8") as f:
+            self.names: List[str] = json.load(f)
+
+    def _map(self, name: str) -> np.ndarray:
+        # plain ndarray view of the mapping: slicing np.memmap itself costs microseconds a call
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r").view(np.ndarray)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def postings(self, term: bytes) -> Tuple[int, int]:
+        """[start, end) of the term's postings; empty when absent."""
+        i = int(np.searchsorted(self.terms, term))
+        if i < len(self.terms) and self.terms[i] == term:
+            return int(self.starts[i]), int(self.starts[i + 1])
+        return 0, 0
+
+
+def merge_segments(a: Segment, b: Segment, path: str) -> None:
+    """Write a segment holding a's docs followed by b's; output arrays are written through mmaps."""
+    terms = np.union1d(a.terms, b.terms)
+    ia = np.searchsorted(terms, a.terms)
+    ib = np.searchsorted(terms, b.terms)
+    count_a = np.zeros(len(terms), np.int64)
+    count_a[ia] = np.diff(a.starts)
+    counts = count_a.copy()
+    counts[ib] += np.diff(b.starts)
+    starts = np.zeros(len(terms) + 1, np.int64)
+    np.cumsum(counts, out=starts[1:])
+
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    total = int(starts[-1])
+    open_memmap = np.lib.format.open_memmap
+    doc_ids = open_memmap(os.path.join(tmp, "doc_ids.npy"), "w+", np.uint32, (total,))
+    tfs = open_memmap(os.path.join(tmp, "tfs.npy"), "w+", np.uint16, (total,))
+    for seg, dest, shift in ((a, starts[ia], 0), (b, starts[ib] + count_a[ib], len(a))):
+        for lo in range(0, len(seg.doc_ids), MERGE_BLOCK):
+            pos = np.arange(lo, min(lo + MERGE_BLOCK, len(seg.doc_ids)))
+            term = np.searchsorted(seg.starts, pos, side="right") - 1
+            out = dest[term] + (pos - seg.starts[term])
+            doc_ids[out] = seg.doc_ids[pos] + shift
+            tfs[out] = seg.tfs[pos]
+    doc_ids.flush()
+    tfs.flush()
+    del doc_ids, tfs
+
+    names = list(a.names)
+    known = {n: i for i, n in enumerate(names)}
+    remap = np.zeros(len(b.names), np.uint32)
+    for i, n in enumerate(b.names):
+        if n not in known:
+            known[n] = len(names)
+            names.append(n)
+        remap[i] = known[n]
+    b_docs = np.array(b.docs)
+    b_docs["name"] = remap[b_docs["name"]]
+    np.save(os.path.join(tmp, "terms.npy"), terms)
+    np.save(os.path.join(tmp, "starts.npy"), starts)
+    np.save(os.path.join(tmp, "doc_len.npy"), np.concatenate([a.doc_len, b.doc_len]))
+    np.save(os.path.join(tmp, "docs.npy"), np.concatenate([np.asarray(a.docs), b_docs]))
+    with open(os.path.join(tmp, "names.json"), "w", encoding="utf-8") as f:
+        json.dump(names, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+# ---------------------------------------------------------------------------
+# Index maintenance
+# ---------------------------------------------------------------------------
+
+def _load_meta(index_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == INDEX_VERSION else None
+
+
+def _save_meta(index_dir: str, meta: dict) -> None:
+    tmp = os.path.join(index_dir, "meta.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(index_dir, "meta.json"))
+
+
+@contextmanager
+def _locked(index_dir: str):
+    """One writer per index directory (several server processes may share it); a no-op without fcntl."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(index_dir, "lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _still_valid(meta: dict, layout: dict) -> bool:
+    """False when the indexed prefix of the dataset is no longer what the builder has on disk."""
+    cursor = meta["cursor"]
+    if meta["sharded"] != layout["sharded"] or meta["audit"] != layout["audit"]:
+        return False
+    if cursor["audit_offset"] and _anchor(layout["audit"], cursor["audit_offset"]) != meta["anchors"]["audit"]:
+        return False
+    if not layout["sharded"]:
+        path = os.path.join(layout["root"], layout["sources"][0]["path"])
+        return _anchor(path, cursor["offset"]) == meta["anchors"]["jsonl"] or cursor["offset"] == 0
+    seen = cursor["source"] + (1 if cursor["offset"] else 0)
+    if seen > len(layout["sources"]):
+        return False
+    return all(old["sha256"] == new["sha256"] for old, new in zip(meta["sources"][:seen], layout["sources"][:seen]))
+
+
+def _fresh_meta(index_dir: str, layout: dict) -> dict:
+    for name in os.listdir(index_dir):
+        if name.startswith("seg-"):
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+    return {
+        "version": INDEX_VERSION,
+        "root": layout["root"],
+        "sharded": layout["sharded"],
+        "audit": layout["audit"],
+        "sources": layout["sources"],
+        "cursor": {"source": 0, "offset": 0, "audit_offset": 0},
+        "anchors": {"jsonl": None, "audit": None},
+        "segments": [],
+        "next_segment": 0,
+    }
+
+
+def _commit(index_dir: str, meta: dict, layout: dict, cursor: dict) -> None:
+    meta["cursor"] = cursor
+    meta["anchors"]["audit"] = _anchor(layout["audit"], cursor["audit_offset"])
+    if not layout["sharded"]:
+        meta["anchors"]["jsonl"] = _anchor(os.path.join(layout["root"], layout["sources"][0]["path"]), cursor["offset"])
+    _save_meta(index_dir, meta)
+
+
+def _segments_present(index_dir: str, meta: dict) -> bool:
+    return all(os.path.isdir(os.path.join(index_dir, seg["name"])) for seg in meta["segments"])
+
+
+def _remove_orphans(index_dir: str, meta: dict) -> None:
+    """
+    Drop seg-* directories meta.json does not list: left by a crash after a segment was
+    written but before meta recorded it (its name would be reused), or after a merge was
+    recorded but before its inputs were removed.
+    """
+    listed = {seg["name"] for seg in meta["segments"]}
+    for name in os.listdir(index_dir):
+        if name.startswith("seg-") and name not in listed:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def _merge_small(index_dir: str, meta: dict, max_segments: int) -> None:
+    """Merge the adjacent pair with the fewest docs until at most max_segments remain."""
+    segs = meta["segments"]
+    while len(segs) > max_segments:
+        i = min(range(len(segs) - 1), key=lambda j: segs[j]["docs"] + segs[j + 1]["docs"])
+        name = f"seg-{meta['next_segment']:06d}"
+        merge_segments(Segment(os.path.join(index_dir, segs[i]["name"])),
+                       Segment(os.path.join(index_dir, segs[i + 1]["name"])), os.path.join(index_dir, name))
+        old = segs[i:i + 2]
+        segs[i:i + 2] = [{"name": name, "docs": old[0]["docs"] + old[1]["docs"],
+                          "total_len": old[0]["total_len"] + old[1]["total_len"]}]
+        meta["next_segment"] += 1
+        _save_meta(index_dir, meta)
+        # open readers keep their mmaps of the removed files
+        for seg in old:
+            shutil.rmtree(os.path.join(index_dir, seg["name"]), ignore_errors=True)
+
+
+def update_index(dataset: str, index_dir: Optional[str] = None, audit: Optional[str] = None,
+                 segment_docs: int = SEGMENT_DOCS, max_segments: int = MAX_SEGMENTS) -> int:
+    """Index the records added to the dataset since the last update; returns how many were added."""
+    index_dir = index_dir or default_index_dir(dataset)
+    os.makedirs(index_dir, exist_ok=True)
+    with _locked(index_dir):
+        layout = dataset_layout(dataset, audit)
+        meta = _load_meta(index_dir)
+        if meta is None or not _still_valid(meta, layout) or not _segments_present(index_dir, meta):
+            meta = _fresh_meta(index_dir, layout)
+        else:
+            _remove_orphans(index_dir, meta)
+        renamed = meta["sources"] != layout["sources"]
+        meta["sources"] = layout["sources"]  # picks up shards renamed by a finished run
+
+        added = 0
+        builder = SegmentBuilder()
+        cursor = meta["cursor"]
+
+        def flush():
+            name = f"seg-{meta['next_segment']:06d}"
+            stats = builder.write(os.path.join(index_dir, name))
+            meta["segments"].append(dict(name=name, **stats))
+            meta["next_segment"] += 1
+            _commit(index_dir, meta, layout, cursor)
+
+        for *record, cursor in _iter_records(meta, layout):
+            builder.add(*record)
+            added += 1
+            if len(builder) >= segment_docs:
+                flush()
+                builder = SegmentBuilder()
+        if len(builder):
+            flush()
+        elif cursor != meta["cursor"] or renamed or not os.path.exists(os.path.join(index_dir, "meta.json")):
+            _commit(index_dir, meta, layout, cursor)
+        _merge_small(index_dir, meta, max_segments)
+    return added
+
+
+# ---------------------------------------------------------------------------
+# Search
+# ---------------------------------------------------------------------------
+
+class BM25Index:
+    """Read-only view of an index directory as of when it was opened."""
+
+    def __init__(self, index_dir: str):
+        meta = _load_meta(index_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No BM25 index in {index_dir} (run: python bm25.py build <dataset.jsonl>)")
+        self.meta = meta
+        self.segments: List[Segment] = []
+        base = 0
+        for seg in meta["segments"]:
+            self.segments.append(Segment(os.path.join(index_dir, seg["name"]), base))
+            base += seg["docs"]
+        self.num_docs = base
+        self.avg_len = sum(s["total_len"] for s in meta["segments"]) / base if base else 0.0
+        # BM25 length normalisation per chunk (4 bytes each, the only per-chunk data held in RAM)
+        self.norms = [(K1 * (1 - B + B * seg.doc_len / max(self.avg_len, 1e-9))).astype(np.float32)
+                      for seg in self.segments]
+
+    def _text(self, doc, max_chars: int) -> Optional[str]:
+        if doc["offset"] < 0:
+            return None  # compressed shard: no cheap random access
+        path = os.path.join(self.meta["root"], self.meta["sources"][doc["source"]]["path"])
+        try:
+            with open(path, "rb") as f:
+                f.seek(int(doc["offset"]))
+                line = f.read(int(doc["length"]))
+        except OSError:
+            return None  # shard renamed since this index was opened; the next update picks that up
+        return json.loads(line)["text"][:max_chars]
+
+    def _top_in_segment(self, seg: Segment, norm: np.ndarray, spans: List[Tuple[int, int]], idf: List[float],
+                        k: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Local doc ids and scores of the segment's top k. Terms are scored rarest first into a
+        dense accumulator (np.zeros is lazily zeroed memory, so this is cheap). Once the k-th
+        best partial score exceeds the most the remaining terms could add (idf * (k1 + 1)
+        each), only docs whose partial score is within that margin of it can still reach the
+        top k: the remaining, more common terms are looked up for those docs alone, by binary
+        search in their sorted postings (MaxScore-style pruning), instead of scoring every posting.
+        """
+        terms = sorted(((span, w) for span, w in zip(spans, idf) if span[1] > span[0]),
+                       key=lambda t: t[0][1] - t[0][0])
+        if not terms:
+            return None
+        remaining = np.cumsum([w * (K1 + 1) for _, w in reversed(terms)])[::-1]
+        acc = np.zeros(len(seg), np.float32)
+        seen: Optional[np.ndarray] = np.zeros(0, np.uint32)  # None once too many docs to track
+        for i, ((start, end), w) in enumerate(terms):
+            if i and (seen is None or len(seen) >= k):
+                partial = acc if seen is None else acc[seen]
+                threshold = np.partition(partial, -k)[-k]
+                if threshold > remaining[i]:
+                    live = np.flatnonzero(partial > threshold - remaining[i])
+                    if seen is not None:
+                        live = seen[live]
+                    for (start, end), w in terms[i:]:
+                        postings = seg.doc_ids[start:end]
+                        j = np.minimum(np.searchsorted(postings, live), len(postings) - 1)
+                        hit = postings[j] == live
+                        tf = seg.tfs[start:end][j[hit]].astype(np.float32)
+                        acc[live[hit]] += np.float32(w * (K1 + 1)) * tf / (tf + norm[live[hit]])
+                    seen = live
+                    break
+            ids = seg.doc_ids[start:end]
+            tf = seg.tfs[start:end].astype(np.float32)
+            acc[ids] += np.float32(w * (K1 + 1)) * tf / (tf + norm[ids])  # ids are unique within one term
+            if seen is not None:
+                seen = np.union1d(seen, ids) if len(seen) + len(ids) <= len(seg) // 4 else None
+        ids = seen if seen is not None else np.flatnonzero(acc)
+        scores = acc[ids]
+        if len(ids) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            ids, scores = ids[top], scores[top]
+        return ids, scores
+
+    def search(self, query: str, k: int = 10, max_chars: int = 0) -> List[Dict[str, Any]]:
+        """Top-k chunks by BM25 (k1=1.2, b=0.75); with max_chars > 0 each hit carries that much of its text."""
+        terms = [t.encode("utf-8") for t in dict.fromkeys(tokenize(query))]
+        if not terms or not self.num_docs or k <= 0:
+            return []
+        spans = [[seg.postings(t) for t in terms] for seg in self.segments]
+        df = [sum(s[i][1] - s[i][0] for s in spans) for i in range(len(terms))]
+        idf = [math.log(1 + (self.num_docs - n + 0.5) / (n + 0.5)) for n in df]
+
+        cand_scores, cand_seg, cand_doc = [], [], []
+        for si, (seg, seg_spans) in enumerate(zip(self.segments, spans)):
+            found = self._top_in_segment(seg, self.norms[si], seg_spans, idf, k)
+            if found is not None:
+                cand_doc.append(found[0])
+                cand_scores.append(found[1])
+                cand_seg.append(np.full(len(found[0]), si))
+        if not cand_scores:
+            return []
+        scores = np.concatenate(cand_scores)
+        seg_of = np.concatenate(cand_seg)
+        doc_of = np.concatenate(cand_doc)
+        results = []
+        for i in np.argsort(-scores, kind="stable")[:k]:
+            seg = self.segments[seg_of[i]]
+            doc = seg.docs[doc_of[i]]
+            hit = {
+                "score": round(float(scores[i]), 4),
+                "chunk_id": int(doc["chunk_id"]),
+                "doc_name": seg.names[doc["name"]],
+                "page_start": int(doc["page_start"]),
+                "page_end": int(doc["page_end"]),
+            }
+            if max_chars > 0:
+                hit["text"] = self._text(doc, max_chars)
+            results.append(hit)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query a BM25 index over a cpt_dataset_builder dataset")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("build", "search"):
+        p = sub.add_parser(name)
+        p.add_argument("dataset", help="dataset.jsonl as passed to --output_jsonl (sharded: the same path)")
+        p.add_argument("--index", help="Index directory (default: <dataset stem>.bm25)")
+        if name == "build":
+            p.add_argument("--audit", help="Audit CSV (default: from the manifest, else audit.csv next to the dataset)")
+            p.add_argument("--segment-docs", type=int, default=SEGMENT_DOCS, help="Records per new segment")
+            p.add_argument("--max-segments", type=int, default=MAX_SEGMENTS,
+                           help="Merge adjacent segments above this many")
+        else:
+            p.add_argument("query")
+            p.add_argument("-k", type=int, default=10)
+            p.add_argument("--max-chars", type=int, default=200, help="Text shown per hit (0: none)")
+    args = parser.parse_args()
+    index_dir = args.index or default_index_dir(args.dataset)
+
+    if args.command == "build":
+        t0 = time.perf_counter()
+        added = update_index(args.dataset, index_dir, args.audit, args.segment_docs, args.max_segments)
+        index = BM25Index(index_dir)
+        print(f"Indexed {added} new record(s) in {time.perf_counter() - t0:.1f}s; "
+              f"{index.num_docs} in {len(index.segments)} segment(s) at {index_dir}")
+        return
+    index = BM25Index(index_dir)
+    t0 = time.perf_counter()
+    hits = index.search(args.query, args.k, args.max_chars)
+    print(f"{len(hits)} hit(s) in {(time.perf_counter() - t0) * 1000:.2f} ms over {index.num_docs} records")
+    for h in hits:
+        print(f"  {h['score']:8.3f}  {h['doc_name']} p.{h['page_start']}-{h['page_end']} (chunk {h['chunk_id']})")
+        if h.get("text"):
+            print("            " + h["text"].replace("\n", " "))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 # client_streamable.py (fixed)
+import argparse
 import asyncio
+import json
 import os
+import platform
+import random
+import time
+from contextlib import AsyncExitStack
+from typing import Dict, List, Optional
+
 from mcp import ClientSession
 from mcp.client.streamable_http import streamablehttp_client
 
@@ -9,8 +17,21 @@ from mcp.client.streamable_http import streamablehttp_client
 # podman exec -it mcp bash
 # export MCP_BASE_URL=http://localhost:8000/mcp
 # python client_streamable.py
+#
+# Load test (see --help):
+# python client_streamable.py bench --sessions 20 --duration 30 --mix add=6,greet=3,get_hn_newest=1
+# python client_streamable.py bench --direct --rate 200 --output bench.json
 
 base_url = os.getenv("MCP_BASE_URL", "http://localhost:8081/mcp")  # default: talk to Nginx from inside container
+DIRECT_URL = "http://localhost:8000/mcp"  # MCP container port, bypassing Nginx
+
+# Arguments used for each tool in a bench mix; other tools are called without arguments
+TOOL_ARGS: Dict[str, dict] = {
+    "add": {"a": 2, "b": 3},
+    "greet": {"name": "MCP"},
+    "get_hn_newest": {"limit": 5},
+    "search_dataset": {"query": "maintenance procedure", "k": 5},
+}
 
 
 async def main():
@@ -31,5 +52,217 @@ async def main():
             result = await session.call_tool("get_hn_newest", {"limit": 5})
             print("get_hn_newest(5) ->", result.content[0].text if result.content else result)
 
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """'add=6,greet=3,get_hn_newest=1' -> relative weights per tool."""
+    mix = {}
+    for part in filter(None, spec.split(",")):
+        name, _, weight = part.partition("=")
+        if float(weight or 1) > 0:
+            mix[name.strip()] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError(f"Empty tool mix: {spec!r}")
+    return mix
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * q // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+class Recorder:
+    """Latencies (seconds) and error counts per tool, for calls that started inside the measured window."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.error_samples: Dict[str, str] = {}
+        self.recording = False
+
+    def record(self, tool: str, seconds: float, error: Optional[str] = None) -> None:
+        if not self.recording:
+            return
+        self.latencies.setdefault(tool, []).append(seconds)
+        if error is not None:
+            self.errors[tool] = self.errors.get(tool, 0) + 1
+            self.error_samples.setdefault(tool, error)
+
+    def summary(self, elapsed: float) -> dict:
+        def stats(values: List[float], errors: int) -> dict:
+            values = sorted(values)
+            ms = [v * 1000 for v in values]
+            return {
+                "calls": len(values),
+                "errors": errors,
+                "throughput_per_sec": round(len(values) / elapsed, 2) if elapsed else None,
+                "mean_ms": round(sum(ms) / len(ms), 3) if ms else None,
+                **{f"p{q}_ms": (round(percentile(ms, q), 3) if ms else None) for q in (50, 95, 99)},
+                "max_ms": round(ms[-1], 3) if ms else None,
+            }
+
+        tools = {name: stats(values, self.errors.get(name, 0)) for name, values in sorted(self.latencies.items())}
+        everything = [v for values in self.latencies.values() for v in values]
+        return {"tools": tools, "total": stats(everything, sum(self.errors.values())),
+                "error_samples": self.error_samples}
+
+
+async def timed_call(session: ClientSession, tool: str, recorder: Recorder, started: Optional[float] = None) -> None:
+    """Call one tool; latency counts from `started` (the scheduled send time in open loop) when given."""
+    t0 = started if started is not None else time.perf_counter()
+    try:
+        result = await session.call_tool(tool, TOOL_ARGS.get(tool, {}))
+        error = (result.content[0].text if result.content else "tool error")[:200] if result.isError else None
+    except Exception as exc:  # transport errors, timeouts, HTTP 5xx from the proxy, ...
+        error = repr(exc)[:200]
+    recorder.record(tool, time.perf_counter() - t0, error)
+
+
+async def closed_loop(session: ClientSession, tools: List[str], weights: List[float], rng: random.Random,
+                      recorder: Recorder, deadline: float, think: float) -> None:
+    """One virtual user: call, wait for the answer, think, repeat until the deadline."""
+    while time.perf_counter() < deadline:
+        await timed_call(session, rng.choices(tools, weights)[0], recorder)
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def open_loop(sessions: List[ClientSession], tools: List[str], weights: List[float], rng: random.Random,
+                    recorder: Recorder, deadline: float, rate: float, max_inflight: int) -> int:
+    """
+    Poisson arrivals at `rate` calls/s spread round-robin over the sessions, sent whether or not
+    earlier calls have answered. Latency is measured from each call's scheduled time, so a
+    stalled server shows up as queueing delay instead of a lower send rate (no coordinated
+    omission). Arrivals beyond max_inflight outstanding calls are dropped and counted.
+    """
+    inflight = set()
+    dropped = 0
+    next_at = time.perf_counter()
+    i = 0
+    while True:
+        next_at += rng.expovariate(rate)
+        if next_at >= deadline:
+            break
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(inflight) >= max_inflight:
+            dropped += 1
+            continue
+        task = asyncio.create_task(timed_call(sessions[i % len(sessions)], rng.choices(tools, weights)[0],
+                                              recorder, started=next_at))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+        i += 1
+    if inflight:
+        await asyncio.wait(inflight)
+    return dropped
+
+
+async def bench(args) -> dict:
+    url = DIRECT_URL if args.direct else args.url
+    mix = parse_mix(args.mix)
+    tools, weights = list(mix), list(mix.values())
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+
+    async with AsyncExitStack() as stack:
+        async def open_session() -> ClientSession:
+            read_stream, write_stream, _ = await stack.enter_async_context(streamablehttp_client(url))
+            session = await stack.enter_async_context(ClientSession(read_stream, write_stream))
+            await session.initialize()
+            return session
+
+        t0 = time.perf_counter()
+        # opened one at a time: AsyncExitStack contexts must be entered and exited in order
+        sessions = [await open_session() for _ in range(args.sessions)]
+        setup_seconds = time.perf_counter() - t0
+        available = {t.name for t in (await sessions[0].list_tools()).tools}
+        missing = sorted(set(tools) - available)
+
+        dropped, elapsed = 0, 0.0
+        for phase, seconds in (("warmup", args.warmup), ("measure", args.duration)):
+            if seconds <= 0 or missing:
+                continue
+            recorder.recording = phase == "measure"
+            start = time.perf_counter()
+            deadline = start + seconds
+            if args.rate:
+                dropped_now = await open_loop(sessions, tools, weights, rng, recorder, deadline, args.rate,
+                                              args.max_inflight)
+            else:
+                await asyncio.gather(*(closed_loop(s, tools, weights, random.Random(rng.random()), recorder,
+                                                   deadline, args.think / 1000) for s in sessions))
+                dropped_now = 0
+            if phase == "measure":
+                elapsed = time.perf_counter() - start
+                dropped = dropped_now
+
+    if missing:
+        # raised outside the session contexts so it is not wrapped in an ExceptionGroup
+        raise SystemExit(f"Tools not offered by {url}: {', '.join(missing)} (available: {', '.join(sorted(available))})")
+    return {
+        "url": url,
+        "mode": "open" if args.rate else "closed",
+        "sessions": args.sessions,
+        "rate_per_sec": args.rate or None,
+        "think_ms": None if args.rate else args.think,
+        "mix": mix,
+        "duration_sec": args.duration,
+        "warmup_sec": args.warmup,
+        "elapsed_sec": round(elapsed, 3),
+        "session_setup_sec": round(setup_seconds, 3),
+        "dropped_arrivals": dropped,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(time.time() - elapsed)),
+        "client_host": platform.node(),
+        **recorder.summary(elapsed),
+    }
+
+
+def print_report(res: dict) -> None:
+    print(f"{res['mode']} loop against {res['url']}: {res['sessions']} session(s), {res['elapsed_sec']}s measured"
+          + (f", target {res['rate_per_sec']}/s, {res['dropped_arrivals']} dropped" if res["mode"] == "open" else ""))
+    print(f"  {'tool':<16}{'calls':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, s in list(res["tools"].items()) + [("TOTAL", res["total"])]:
+        cells = [s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"]]
+        print(f"  {name:<16}{s['calls']:>8}{s['errors']:>8}{s['throughput_per_sec'] or 0:>9.1f}"
+              + "".join(f"{c:>9.1f}" if c is not None else f"{'-':>9}" for c in cells))
+    for name, sample in res["error_samples"].items():
+        print(f"  first {name} error: {sample}")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="MCP streamable-HTTP smoke test and load generator")
+    sub = parser.add_subparsers(dest="command")
+    b = sub.add_parser("bench", help="Concurrent load test with per-tool latency percentiles")
+    b.add_argument("--url", default=base_url, help="MCP endpoint (default: $MCP_BASE_URL or Nginx on :8081)")
+    b.add_argument("--direct", action="store_true", help=f"Target the MCP container directly ({DIRECT_URL})")
+    b.add_argument("--sessions", type=int, default=10, help="Concurrent ClientSessions")
+    b.add_argument("--duration", type=float, default=30, help="Measured seconds (must be > 0)")
+    b.add_argument("--warmup", type=float, default=5, help="Unmeasured seconds before measuring")
+    b.add_argument("--mix", default="add=1,greet=1,get_hn_newest=1", help="Relative weights per tool, e.g. add=6,greet=3")
+    b.add_argument("--rate", type=float, default=0,
+                   help="Open loop: total calls/s (Poisson) regardless of response times. Default: closed loop")
+    b.add_argument("--think", type=float, default=0, help="Closed loop: mean think time between calls (ms)")
+    b.add_argument("--max-inflight", type=int, default=1000, help="Open loop: drop arrivals beyond this many outstanding")
+    b.add_argument("--seed", type=int, default=1)
+    b.add_argument("--output", help="Write results as JSON here (for regression tracking)")
+    args = parser.parse_args()
+    if args.command == "bench" and (args.duration <= 0 or args.sessions < 1):
+        parser.error("bench needs --duration > 0 and --sessions >= 1")
+
+    if args.command != "bench":
+        asyncio.run(main())
+        return
+    res = asyncio.run(bench(args))
+    print_report(res)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(res, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli()
@@ -0,0 +1,113 @@
+# metrics.py
+"""Tiny in-process metrics registry rendered in the Prometheus text format.
+
+Only touched from the server's event loop, so there is no locking. Kept dependency-free
+on purpose; swap for prometheus_client if the server ever grows multiple processes.
+"""
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Seconds; tool calls range from sub-millisecond (add) to upstream fetches (seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in sorted(self.values.items())]
+        return out
+
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_labels(labels)] = value
+
+    def render(self) -> List[str]:
+        out = super().render()
+        out[1] = f"# TYPE {self.name} gauge"
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name, self.help = name, help_text
+        self.buckets = buckets
+        self.series: Dict[Labels, List[float]] = {}  # labels -> per-bucket counts + [+Inf count, sum]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        s = self.series.get(key)
+        if s is None:
+            s = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(self.series.items()):
+            cumulative = 0
+            for le, n in zip(self.buckets + (float("inf"),), s[:-1]):
+                cumulative += n
+                out.append(f"{self.name}_bucket{_fmt_labels(key + (('le', _fmt_value(le)),))} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(s[-1])}")
+            out.append(f"{self.name}_count{_fmt_labels(key)} {cumulative}")
+        return out
+
+
+class Registry:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.families: List = []
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(f"{self.prefix}_{name}", help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._add(Gauge(f"{self.prefix}_{name}", help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(f"{self.prefix}_{name}", help_text, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for family in self.families:
+            lines += family.render()
+        return "\n".join(lines) + "\n"
@@ -1,30 +1,316 @@
 # server.py
 from __future__ import annotations
+import asyncio
+import functools
+import logging
 import os
-from typing import List, Dict, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 
 from mcp.server.fastmcp import FastMCP
 import feedparser
+import httpx
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+import bm25
+from metrics import Registry
 
 
 mcp = FastMCP("DemoMCP", host="0.0.0.0", port=8000)
 
+# Point HN_FEED_URL at a local stand-in feed to test without hitting hnrss.org
+HN_FEED_URL = os.getenv("HN_FEED_URL", "https://hnrss.org/newest")
+FEED_TTL_SECONDS = float(os.getenv("FEED_TTL_SECONDS", "60"))
+FEED_MAX_STALE_SECONDS = float(os.getenv("FEED_MAX_STALE_SECONDS", "600"))
+FEED_TIMEOUT_SECONDS = float(os.getenv("FEED_TIMEOUT_SECONDS", "10"))
+FEED_RETRY_SECONDS = 10.0
+FEED_MAX_ITEMS = 100
+
+# BM25 search over a cpt_dataset_builder dataset (the --output_jsonl path; sharded output is
+# found through its manifest). Unset leaves search_dataset reporting that nothing is configured.
+BM25_DATASET = os.getenv("BM25_DATASET")
+# The builder's --output_csv; unset uses the manifest's, else audit.csv next to the dataset
+BM25_AUDIT = os.getenv("BM25_AUDIT")
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR") or (bm25.default_index_dir(BM25_DATASET) if BM25_DATASET else None)
+BM25_REFRESH_SECONDS = float(os.getenv("BM25_REFRESH_SECONDS", "60"))
+
+# Max concurrent calls per tool; override with e.g. TOOL_CONCURRENCY="get_hn_newest=4,add=128"
+TOOL_CONCURRENCY: Dict[str, int] = {"add": 64, "greet": 64, "get_hn_newest": 16, "search_dataset": 8}
+for _spec in filter(None, os.getenv("TOOL_CONCURRENCY", "").split(",")):
+    _name, _, _limit = _spec.partition("=")
+    TOOL_CONCURRENCY[_name.strip()] = int(_limit)
+
+# Log tool calls slower than this (seconds, including time queued for the concurrency limit); 0 disables
+SLOW_CALL_SECONDS = float(os.getenv("SLOW_CALL_SECONDS", "1.0"))
+
+log = logging.getLogger("demo_mcp")
+
+registry = Registry("mcp")
+tool_calls = registry.counter("tool_calls_total", "Tool calls by tool and status (ok/error).")
+tool_latency = registry.histogram("tool_call_duration_seconds",
+                                  "Tool call latency, including time waiting for the concurrency limit.")
+tool_in_flight = registry.gauge("tool_in_flight", "Tool calls currently executing.")
+tool_waiting = registry.gauge("tool_waiting", "Tool calls queued behind the per-tool concurrency limit.")
+tool_slow_calls = registry.counter("tool_slow_calls_total", "Tool calls slower than SLOW_CALL_SECONDS.")
+feed_requests = registry.counter("feed_requests_total", "Feed cache lookups by result (fresh/stale/miss).")
+feed_fetches = registry.counter("feed_fetches_total", "Upstream feed fetches by result (200/304/error).")
+feed_fetch_latency = registry.histogram("feed_fetch_duration_seconds", "Upstream feed fetch time, including parsing.")
+index_documents = registry.gauge("bm25_documents", "Chunks in the open BM25 index.")
+index_updates = registry.counter("bm25_updates_total", "BM25 index updates by result (ok/error).")
+index_update_latency = registry.histogram("bm25_update_duration_seconds", "BM25 index update time, including reopening.")
+
+# feedparser is CPU-bound pure Python; keep it off the event loop
+parse_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PARSE_THREADS", "2")), thread_name_prefix="feed-parse")
+# BM25 queries are numpy over mmaps; index updates get their own thread so a long build never holds up queries
+search_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_THREADS", "4")), thread_name_prefix="bm25-search")
+index_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bm25-update")
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """Process-wide pooled HTTP client (keep-alive connections, timeouts), created on first use."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(FEED_TIMEOUT_SECONDS, connect=min(5.0, FEED_TIMEOUT_SECONDS)),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            headers={"User-Agent": "DemoMCP/1.0"},
+            follow_redirects=True,
+        )
+    return _http_client
+
+
+def instrumented(name: str):
+    """Wrap an async tool: cap concurrent calls at TOOL_CONCURRENCY[name] (extra calls wait
+    their turn), record call counts, latency, in-flight/queued gauges, and log slow calls."""
+    semaphore = asyncio.Semaphore(TOOL_CONCURRENCY.get(name, 32))
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = "error"
+            try:
+                tool_waiting.inc(tool=name)
+                try:
+                    await semaphore.acquire()
+                finally:
+                    tool_waiting.dec(tool=name)
+                tool_in_flight.inc(tool=name)
+                try:
+                    result = await fn(*args, **kwargs)
+                finally:
+                    tool_in_flight.dec(tool=name)
+                    semaphore.release()
+                status = "ok"
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                tool_calls.inc(tool=name, status=status)
+                tool_latency.observe(elapsed, tool=name)
+                if SLOW_CALL_SECONDS and elapsed >= SLOW_CALL_SECONDS:
+                    tool_slow_calls.inc(tool=name)
+                    log.warning("slow tool call: %s took %.3fs (status=%s, args=%s)", name, elapsed, status,
+                                kwargs or args)
+        return wrapper
+    return decorate
+
+
+def _entry_to_item(entry) -> Dict[str, Any]:
+    return {
+        "title": getattr(entry, "title", None),
+        "link": getattr(entry, "link", None),
+        "published": getattr(entry, "published", None),
+        "id": getattr(entry, "id", None),
+        "comments": getattr(entry, "comments", None),
+        "author": getattr(entry, "author", None),
+    }
+
+
+def _parse_items(body: bytes) -> List[Dict[str, Any]]:
+    feed = feedparser.parse(body)
+    if feed.bozo and not feed.entries:
+        raise feed.bozo_exception
+    return [_entry_to_item(e) for e in feed.entries[:FEED_MAX_ITEMS]]
+
+
+class FeedCache:
+    """Shared, TTL-cached copy of one RSS/Atom feed.
+
+    * Fresh (younger than ttl): served from memory.
+    * Stale (up to max_stale past ttl): served from memory while one background
+      task revalidates it.
+    * Empty or too old: callers await the refresh.
+
+    Only one refresh runs at a time; concurrent callers share its result. Refreshes
+    go through the pooled http_client() with If-None-Match / If-Modified-Since, so an
+    unchanged feed costs a 304, and new bodies are parsed on parse_pool. A failed
+    refresh keeps the old items, still aged from the last successful fetch, and no new
+    one starts for FEED_RETRY_SECONDS; until then callers that cannot be served from
+    memory get the error.
+    """
+
+    def __init__(self, url: str, ttl: float = 60.0, max_stale: float = 600.0):
+        self.url = url
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._items: Optional[List[Dict[str, Any]]] = None
+        self._etag: Optional[str] = None
+        self._modified: Optional[str] = None
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self._error: Optional[BaseException] = None
+        self._inflight: Optional[asyncio.Task] = None
+
+    async def get(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        age = now - self._fetched_at
+        if self._items is not None and age < self.ttl:
+            feed_requests.inc(result="fresh")
+            return self._items
+        if self._inflight is None and now >= self._retry_at:
+            self._inflight = asyncio.create_task(self._refresh())
+        if self._items is not None and age < self.ttl + self.max_stale:
+            feed_requests.inc(result="stale")
+            return self._items
+        feed_requests.inc(result="miss")
+        if self._inflight is not None:
+            # shield: a cancelled caller must not cancel the refresh other callers wait on
+            await asyncio.shield(self._inflight)
+        if self._items is None or time.monotonic() - self._fetched_at >= self.ttl + self.max_stale:
+            raise RuntimeError(f"Could not fetch {self.url}: {self._error!r}")
+        return self._items
+
+    async def _refresh(self) -> None:
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._modified:
+            headers["If-Modified-Since"] = self._modified
+        started = time.perf_counter()
+        result = "error"
+        try:
+            resp = await http_client().get(self.url, headers=headers)
+            result = str(resp.status_code)
+            if resp.status_code != 304 or self._items is None:
+                resp.raise_for_status()
+                loop = asyncio.get_running_loop()
+                self._items = await loop.run_in_executor(parse_pool, _parse_items, resp.content)
+                self._etag = resp.headers.get("etag")
+                self._modified = resp.headers.get("last-modified")
+            self._fetched_at = time.monotonic()
+            self._error = None
+        except Exception as exc:
+            result = "error"
+            self._error = exc
+            self._retry_at = time.monotonic() + FEED_RETRY_SECONDS
+            log.warning("feed refresh from %s failed: %r", self.url, exc)
+        finally:
+            self._inflight = None
+            feed_fetches.inc(result=result)
+            feed_fetch_latency.observe(time.perf_counter() - started, result=result)
+
+
+hn_feed = FeedCache(HN_FEED_URL, FEED_TTL_SECONDS, FEED_MAX_STALE_SECONDS)
+
+
+class DatasetIndex:
+    """BM25 index over one cpt_dataset_builder dataset (see bm25.py).
+
+    * An existing index is memory-mapped once, when the server starts. One that cannot
+      be opened (corrupt meta.json, missing segment) is logged and rebuilt by the first
+      search, so it never stops the server.
+    * A search at least refresh_seconds after the last update starts one background
+      bm25.update_index() on index_pool, which indexes only records and shards added
+      since, and keeps answering from the open index until the updated one is swapped in.
+      refresh_seconds <= 0 updates once, on the first search.
+    * Without an index yet, searches wait for the first build.
+    """
+
+    def __init__(self, dataset: Optional[str], index_dir: Optional[str], refresh_seconds: float = 60.0,
+                 audit: Optional[str] = None):
+        self.dataset = dataset
+        self.index_dir = index_dir
+        self.audit = audit
+        self.refresh_seconds = refresh_seconds
+        self._index: Optional[bm25.BM25Index] = None
+        self._updated_at: Optional[float] = None
+        self._error: Optional[BaseException] = None
+        self._inflight: Optional[asyncio.Task] = None
+        if dataset and os.path.exists(os.path.join(index_dir, "meta.json")):
+            try:
+                self._index = bm25.BM25Index(index_dir)
+                index_documents.set(self._index.num_docs)
+            except Exception as exc:
+                self._error = exc
+                log.warning("Could not open BM25 index %s, rebuilding on first search: %r", index_dir, exc)
+
+    def _due(self, now: float) -> bool:
+        if self._updated_at is None:
+            return True
+        return self.refresh_seconds > 0 and now >= self._updated_at + self.refresh_seconds
+
+    async def search(self, query: str, k: int, max_chars: int) -> List[Dict[str, Any]]:
+        if not self.dataset:
+            raise RuntimeError("No dataset configured: set BM25_DATASET to a cpt_dataset_builder dataset.jsonl")
+        if self._inflight is None and self._due(time.monotonic()):
+            self._inflight = asyncio.create_task(self._update())
+        if self._index is None and self._inflight is not None:
+            # shield: a cancelled caller must not cancel the build other callers wait on
+            await asyncio.shield(self._inflight)
+        index = self._index
+        if index is None:
+            raise RuntimeError(f"No BM25 index for {self.dataset}: {self._error!r}")
+        return await asyncio.get_running_loop().run_in_executor(search_pool, index.search, query, k, max_chars)
+
+    async def _update(self) -> None:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        result = "error"
+        try:
+            added = await loop.run_in_executor(index_pool, bm25.update_index, self.dataset, self.index_dir,
+                                               self.audit)
+            # reopened even when nothing was added: a finished sharded run renames its shards
+            self._index = await loop.run_in_executor(index_pool, bm25.BM25Index, self.index_dir)
+            index_documents.set(self._index.num_docs)
+            if added:
+                log.info("BM25 index for %s: %d new chunk(s), %d total", self.dataset, added, self._index.num_docs)
+            self._error = None
+            result = "ok"
+        except Exception as exc:
+            self._error = exc
+            log.warning("BM25 index update for %s failed: %r", self.dataset, exc)
+        finally:
+            self._updated_at = time.monotonic()
+            self._inflight = None
+            index_updates.inc(result=result)
+            index_update_latency.observe(time.perf_counter() - started)
+
+
+dataset_index = DatasetIndex(BM25_DATASET, BM25_INDEX_DIR, BM25_REFRESH_SECONDS, BM25_AUDIT)
+
 
 @mcp.tool()
-def add(a: float, b: float) -> float:
+@instrumented("add")
+async def add(a: float, b: float) -> float:
     """Add two numbers and return the sum."""
     return a + b
 
 
 @mcp.tool()
-def greet(name: str = "World") -> str:
+@instrumented("greet")
+async def greet(name: str = "World") -> str:
     """Return a friendly greeting for the given name."""
     return f"Hello, {name}! ✨"
 
 
 @mcp.tool()
-def get_hn_newest(limit: int = 10) -> List[Dict[str, Any]]:
-    """Fetch the newest Hacker News posts via hnrss.org/newest.
+@instrumented("get_hn_newest")
+async def get_hn_newest(limit: int = 10) -> List[Dict[str, Any]]:
+    """Fetch the newest Hacker News posts via hnrss.org/newest (cached for FEED_TTL_SECONDS).
 
     Args:
     limit: max number of items to return (default 10)
@@ -32,18 +318,30 @@ def get_hn_newest(limit: int = 10) -> List[Dict[str, Any]]:
     Returns:
     A list of dicts with keys: title, link, published, id, comments, author
     """
-    feed = feedparser.parse("https://hnrss.org/newest")
-    items: List[Dict[str, Any]] = []
-    for entry in feed.entries[: max(0, min(limit, 100))]:
-        items.append({
-            "title": getattr(entry, "title", None),
-            "link": getattr(entry, "link", None),
-            "published": getattr(entry, "published", None),
-            "id": getattr(entry, "id", None),
-            "comments": getattr(entry, "comments", None),
-            "author": getattr(entry, "author", None),
-        })
-    return items
+    return (await hn_feed.get())[: max(0, min(limit, FEED_MAX_ITEMS))]
+
+
+@mcp.tool()
+@instrumented("search_dataset")
+async def search_dataset(query: str, k: int = 10, max_chars: int = 300) -> List[Dict[str, Any]]:
+    """Keyword (BM25) search over the CPT dataset built by cpt_dataset_builder (BM25_DATASET).
+
+    Args:
+    query: words to look for
+    k: number of chunks to return (default 10, at most 100)
+    max_chars: characters of each chunk's text to include (default 300, 0 for none)
+
+    Returns:
+    Best matches first, as dicts with keys: score, chunk_id, doc_name, page_start, page_end,
+    and text (None for chunks in compressed shards) when max_chars > 0
+    """
+    return await dataset_index.search(query, max(1, min(k, 100)), max(0, max_chars))
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """Prometheus scrape endpoint (HTTP transport only), next to /mcp on the same port."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 if __name__ == "__main__":
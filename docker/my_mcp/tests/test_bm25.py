@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import bm25  # noqa: E402
+
+
+def write_records(dataset, audit, texts, start=0):
+    new = not os.path.exists(audit)
+    with open(dataset, "a", encoding="utf-8") as fj, open(audit, "a", encoding="utf-8") as fa:
+        if new:
+            fa.write("chunk_id,doc_name,page_start,page_end,approx_tokens\n")
+        for i, text in enumerate(texts, start):
+            fj.write(json.dumps({"text": text}) + "\n")
+            fa.write(f"{i},doc.pdf,{i + 1},{i + 1},{len(text.split())}\n")
+
+
+def test_update_after_orphan_segment(tmp_path):
+    dataset, audit, index_dir = str(tmp_path / "dataset.jsonl"), str(tmp_path / "audit.csv"), str(tmp_path / "idx")
+    write_records(dataset, audit, ["hydraulic pump pressure", "brake fluid reservoir"])
+    assert bm25.update_index(dataset, index_dir, segment_docs=1) == 2
+
+    # a crash between writing a segment and recording it in meta.json leaves this behind
+    meta = json.load(open(os.path.join(index_dir, "meta.json")))
+    orphan = os.path.join(index_dir, f"seg-{meta['next_segment']:06d}")
+    os.makedirs(orphan)
+    open(os.path.join(orphan, "terms.npy"), "wb").close()
+
+    write_records(dataset, audit, ["turbine blade inspection"], start=2)
+    assert bm25.update_index(dataset, index_dir, segment_docs=1) == 1
+    hits = bm25.BM25Index(index_dir).search("turbine", k=1)
+    assert [hit["chunk_id"] for hit in hits] == [2]
+
+
+def test_update_rebuilds_when_a_segment_is_missing(tmp_path):
+    dataset, audit, index_dir = str(tmp_path / "dataset.jsonl"), str(tmp_path / "audit.csv"), str(tmp_path / "idx")
+    write_records(dataset, audit, ["hydraulic pump pressure", "brake fluid reservoir"])
+    bm25.update_index(dataset, index_dir, segment_docs=1)
+    meta = json.load(open(os.path.join(index_dir, "meta.json")))
+    bm25.shutil.rmtree(os.path.join(index_dir, meta["segments"][0]["name"]))
+
+    assert bm25.update_index(dataset, index_dir, segment_docs=1) == 2
+    assert bm25.BM25Index(index_dir).num_docs == 2